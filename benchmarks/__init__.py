@@ -0,0 +1,9 @@
+"""
+Benchmarks for the hot paths of RibbonGraph.
+
+Run them from the root of the repository with
+
+    python -m benchmarks --output results.json
+
+against an in-memory graph, or with --database-url against a local Neo4j.
+"""
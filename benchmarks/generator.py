@@ -0,0 +1,166 @@
+"""
+Generates synthetic social graphs.
+
+Friendships are made by preferential attachment, every new user befriending
+users with probability proportional to how many friends they already have,
+which gives the power-law degree distribution of real social graphs. Event
+sizes are drawn from a Pareto distribution and attendees are again picked by
+popularity, so a few users and events are very well connected and most are
+not.
+"""
+import datetime
+import random
+from ribbon.query_builder import BASE_LABEL
+
+
+DEFAULT_USERS = 1000
+DEFAULT_FRIENDS_PER_USER = 5
+DEFAULT_EVENTS = 100
+DEFAULT_ATTENDANCE_ALPHA = 1.5
+DEFAULT_MIN_ATTENDEES = 3
+DEFAULT_BATCH_SIZE = 500
+
+CITIES = ['Austin', 'Berlin', 'Lagos', 'Lima', 'Osaka', 'Oslo', 'Pune', 'Quito']
+
+
+class SocialGraph(object):
+    """
+    The ids of the generated nodes, with the number of friends of each user.
+    """
+    def __init__(self, user_ids, event_ids, friend_counts):
+        self.user_ids = user_ids
+        self.event_ids = event_ids
+        self.friend_counts = friend_counts
+
+    def most_connected_users(self, count):
+        return sorted(self.user_ids, key=lambda id: self.friend_counts[id], reverse=True)[:count]
+
+    def summary(self):
+        degrees = sorted(self.friend_counts.values())
+        return {
+            'users': len(self.user_ids),
+            'events': len(self.event_ids),
+            'friendships': sum(degrees) / 2,
+            'max_friends': degrees[-1] if degrees else 0,
+            'median_friends': degrees[len(degrees) / 2] if degrees else 0,
+        }
+
+
+class _Writer(object):
+    """
+    Writes nodes and edges through the backend of the graph, committing every
+    batch_size writes so that no transaction grows without bound.
+    """
+    def __init__(self, graph, batch_size):
+        self.graph = graph
+        self.batch_size = batch_size
+        self.tx = None
+        self.pending = 0
+
+    def create_node(self, node_type, creator_id=None, **properties):
+        id = self.graph.id_allocator.next_id()
+        now = datetime.datetime.now().isoformat()
+        properties.update({
+            'id': id,
+            'created_at': now,
+            'updated_at': now,
+            'created_by': creator_id if creator_id is not None else id,
+        })
+        self._transaction().create_node([node_type, BASE_LABEL], properties)
+        self._wrote()
+        return id
+
+    def add_edge(self, relationship, from_node_id, to_node_id):
+        relationship.add(self._transaction(), from_node_id, to_node_id)
+        self._wrote()
+
+    def flush(self):
+        if self.tx:
+            self.tx.commit()
+            self.tx = None
+            self.pending = 0
+
+    def _transaction(self):
+        if not self.tx:
+            self.tx = self.graph.backend.begin()
+        return self.tx
+
+    def _wrote(self):
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+
+def _pick(rng, weighted_ids, count):
+    """
+    Picks count distinct ids, each with probability proportional to how often
+    it appears in weighted_ids.
+    """
+    count = min(count, len(set(weighted_ids)))
+    picked = set()
+    while len(picked) < count:
+        picked.add(rng.choice(weighted_ids))
+    return sorted(picked)
+
+
+def generate_social_graph(graph,
+                          users=DEFAULT_USERS,
+                          friends_per_user=DEFAULT_FRIENDS_PER_USER,
+                          events=DEFAULT_EVENTS,
+                          attendance_alpha=DEFAULT_ATTENDANCE_ALPHA,
+                          min_attendees=DEFAULT_MIN_ATTENDEES,
+                          seed=0,
+                          batch_size=DEFAULT_BATCH_SIZE,
+                          user_model='User',
+                          event_model='Event',
+                          friends='friends',
+                          hosted_events='hosted_events',
+                          attended_events='events'):
+    """
+    Fills the graph with users and events and returns the SocialGraph
+    describing them. The models and relationships default to those of
+    benchmarks.schema, and the same seed always generates the same graph.
+    """
+    rng = random.Random(seed)
+    user_relationships = graph.models_dict[user_model].relationships()
+    friends = user_relationships[friends]
+    hosted_events = user_relationships[hosted_events]
+    attended_events = user_relationships[attended_events]
+
+    writer = _Writer(graph, batch_size)
+    user_ids = []
+    friend_counts = {}
+    # Every user appears once, plus once for every friend, so that users are
+    # befriended in proportion to their degree.
+    weighted_ids = []
+    for i in xrange(users):
+        id = writer.create_node(
+            user_model,
+            name='user{}'.format(i),
+            age=rng.randint(18, 80),
+            city=rng.choice(CITIES))
+        friend_counts[id] = 0
+        for friend_id in _pick(rng, weighted_ids, friends_per_user):
+            writer.add_edge(friends, id, friend_id)
+            friend_counts[id] += 1
+            friend_counts[friend_id] += 1
+            weighted_ids.extend([id, friend_id])
+        weighted_ids.append(id)
+        user_ids.append(id)
+
+    event_ids = []
+    for i in xrange(events):
+        host_id = rng.choice(weighted_ids)
+        size = int(min_attendees * rng.paretovariate(attendance_alpha))
+        id = writer.create_node(
+            event_model,
+            creator_id=host_id,
+            title='event{}'.format(i),
+            capacity=size)
+        writer.add_edge(hosted_events, host_id, id)
+        for attendee_id in _pick(rng, weighted_ids, size):
+            writer.add_edge(attended_events, attendee_id, id)
+        event_ids.append(id)
+
+    writer.flush()
+    return SocialGraph(user_ids, event_ids, friend_counts)
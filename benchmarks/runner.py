@@ -0,0 +1,208 @@
+"""
+Times the hot paths of RibbonGraph against a generated social graph and saves
+the results as JSON, so that runs can be compared across commits.
+
+Each benchmark reports latency percentiles in milliseconds, throughput in
+operations per second and, for the GraphAPI benchmarks, the number of round
+trips every request made to Neo4j, as recorded in its RequestMetrics. The
+in-memory graph makes none.
+"""
+import argparse
+import datetime
+import json
+import random
+import subprocess
+import sys
+import time
+from ribbon.cypher_utils import constraints_expression_from_constraints
+from ribbon.graph import GraphAPI
+from ribbon.instrumentation import Instrumentation
+from ribbon.memory_backend import MemoryBackend
+from ribbon.parsing import ParamParser, _parse_query_params
+from generator import generate_social_graph, DEFAULT_USERS, DEFAULT_FRIENDS_PER_USER, DEFAULT_EVENTS
+from schema import MODELS
+
+
+DEFAULT_ITERATIONS = 200
+DEFAULT_WARMUP = 20
+PERCENTILES = [50, 90, 95, 99]
+
+SUBGRAPH_INCLUDE = 'name,city,friends.limit(20).include(name,age),events.limit(10).include(title,attendees.limit(5).include(name))'
+QUERY_PARAMS = {
+    'include': 'name,age,friends.limit(10).include(name)',
+    'where': 'age>=30,age<40|city=Oslo',
+    'order_by': 'age,desc',
+    'limit': '25',
+}
+CONSTRAINTS_STRING = 'age>=30,age<40,city!=Oslo|name=user7,email.matches(.*@example.com)|age<20'
+
+class RoundTripCounter(Instrumentation):
+    """
+    Adds up the round trips recorded in the metrics of every request.
+    """
+    def __init__(self):
+        self.round_trips = 0
+
+    def request_finished(self, metrics):
+        self.round_trips += metrics.round_trips
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = int(round((len(sorted_values) - 1) * p / 100.0))
+    return sorted_values[index]
+
+
+def measure(operation, iterations, warmup=DEFAULT_WARMUP, counter=None):
+    """
+    Calls operation(i) warmup times untimed and then iterations times, and
+    returns the summary of the timed calls.
+    """
+    for i in xrange(warmup):
+        operation(i)
+    round_trips = counter.round_trips if counter else 0
+    latencies = []
+    started = time.time()
+    for i in xrange(iterations):
+        call_started = time.time()
+        operation(i)
+        latencies.append((time.time() - call_started) * 1000.0)
+    elapsed = time.time() - started
+
+    latencies.sort()
+    summary = {
+        'iterations': iterations,
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'max_ms': latencies[-1] if latencies else None,
+        'throughput_per_s': iterations / elapsed if elapsed else None,
+    }
+    for p in PERCENTILES:
+        summary['p{}_ms'.format(p)] = percentile(latencies, p)
+    if counter:
+        summary['round_trips_per_request'] = float(counter.round_trips - round_trips) / iterations
+    return summary
+
+
+def build_benchmarks(graph, social_graph, seed=0):
+    """
+    Returns the list of (name, operation, counts_round_trips) benchmarks.
+    """
+    rng = random.Random(seed)
+    hot_user_ids = social_graph.most_connected_users(10)
+    user_ids = list(social_graph.user_ids)
+    rng.shuffle(user_ids)
+    subgraph_include = ParamParser.parse_include_list(SUBGRAPH_INCLUDE)
+    query_dict = _parse_query_params(
+        QUERY_PARAMS['include'], QUERY_PARAMS['where'], None, QUERY_PARAMS['order_by'], QUERY_PARAMS['limit'])
+    constraints = ParamParser.parse_constraint_list(CONSTRAINTS_STRING)
+
+    def request_subgraph(i):
+        id = user_ids[i % len(user_ids)]
+        graph.request_subgraph_at_node(id, subgraph_include, id)
+
+    def request_hot_subgraph(i):
+        id = hot_user_ids[i % len(hot_user_ids)]
+        graph.request_subgraph_at_node(id, subgraph_include, id)
+
+    def request_subgraph_breadth_first(i):
+        id = user_ids[i % len(user_ids)]
+        graph.request_subgraph_at_node(id, subgraph_include, id, breadth_first=True)
+
+    def query_for_subgraphs(i):
+        graph.query_for_subgraphs(user_ids[i % len(user_ids)], query_dict, 'User')
+
+    def update_subgraph(i):
+        id = user_ids[i % len(user_ids)]
+        graph.update_subgraph_at_node(id, 'update', {'city': 'city{}'.format(i)}, id=id)
+
+    def parse_include(i):
+        ParamParser.parse_include_list(SUBGRAPH_INCLUDE)
+
+    def parse_query_params(i):
+        _parse_query_params(
+            QUERY_PARAMS['include'], QUERY_PARAMS['where'], None, QUERY_PARAMS['order_by'], QUERY_PARAMS['limit'])
+
+    def constraints_expression(i):
+        constraints_expression_from_constraints(constraints)
+
+    return [
+        ('request_subgraph_at_node', request_subgraph, True),
+        ('request_subgraph_at_node_hot', request_hot_subgraph, True),
+        ('request_subgraph_at_node_breadth_first', request_subgraph_breadth_first, True),
+        ('query_for_subgraphs', query_for_subgraphs, True),
+        ('update_subgraph_at_node', update_subgraph, True),
+        ('param_parser_include', parse_include, False),
+        ('param_parser_query', parse_query_params, False),
+        ('constraints_expression_from_constraints', constraints_expression, False),
+    ]
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(database_url=None,
+        users=DEFAULT_USERS,
+        friends_per_user=DEFAULT_FRIENDS_PER_USER,
+        events=DEFAULT_EVENTS,
+        iterations=DEFAULT_ITERATIONS,
+        warmup=DEFAULT_WARMUP,
+        seed=0,
+        only=None):
+    """
+    Generates a social graph, in memory or in the Neo4j database at
+    database_url, runs the benchmarks named in only (or all of them) and
+    returns the results.
+    """
+    counter = RoundTripCounter()
+    backend = None if database_url else MemoryBackend()
+    graph = GraphAPI(database_url, models=MODELS, backend=backend, instrumentation=counter)
+    graph.setup_constraints()
+
+    started = time.time()
+    social_graph = generate_social_graph(graph, users, friends_per_user, events, seed=seed)
+    generation_time = time.time() - started
+
+    results = {}
+    for name, operation, counts_round_trips in build_benchmarks(graph, social_graph, seed):
+        if only and name not in only:
+            continue
+        results[name] = measure(operation, iterations, warmup, counter if counts_round_trips else None)
+
+    return {
+        'commit': current_commit(),
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'backend': 'neo4j' if database_url else 'memory',
+        'python': sys.version.split()[0],
+        'graph': dict(social_graph.summary(), generation_s=generation_time, seed=seed),
+        'benchmarks': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the hot paths of RibbonGraph.')
+    parser.add_argument('--database-url', help='Neo4j database to generate the graph in. '
+                        'Defaults to an in-memory graph. The database should be empty.')
+    parser.add_argument('--users', type=int, default=DEFAULT_USERS)
+    parser.add_argument('--friends-per-user', type=int, default=DEFAULT_FRIENDS_PER_USER)
+    parser.add_argument('--events', type=int, default=DEFAULT_EVENTS)
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', action='append', help='Name of a benchmark to run. May be repeated.')
+    parser.add_argument('--output', help='File to write the JSON results to. Defaults to stdout.')
+    args = parser.parse_args(argv)
+
+    results = run(args.database_url, args.users, args.friends_per_user, args.events,
+                  args.iterations, args.warmup, args.seed, args.only)
+    output = json.dumps(results, sort_keys=True, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+    return 0
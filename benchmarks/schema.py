@@ -0,0 +1,25 @@
+"""
+The default social graph schema: users who befriend each other and host and
+attend events. Any schema with models and relationships of the same shape can
+be generated by passing their names to generate_social_graph.
+"""
+from ribbon.node_model import NodeModel, Attribute, Relationship, Allows
+
+
+class User(NodeModel):
+    name = Attribute(read=Allows.public)
+    age = Attribute(read=Allows.public)
+    city = Attribute(read=Allows.public)
+    friends = Relationship('User', rel_type='FRIENDS_WITH', read=Allows.public)
+    hosted_events = Relationship('Event', rel_type='HOSTS', direction='outgoing', read=Allows.public)
+    events = Relationship('Event', rel_type='ATTENDS', direction='outgoing', read=Allows.public)
+
+
+class Event(NodeModel):
+    title = Attribute(read=Allows.public)
+    capacity = Attribute(read=Allows.public)
+    host = Relationship('User', rel_type='HOSTS', direction='incoming', max_edges=1, read=Allows.public)
+    attendees = Relationship('User', rel_type='ATTENDS', direction='incoming', read=Allows.public)
+
+
+MODELS = [User, Event]
@@ -0,0 +1,41 @@
+"""
+A non-blocking front end to GraphAPI.
+
+Every method of AsyncGraphAPI submits the corresponding GraphAPI call to a
+bounded pool of worker threads and immediately returns a
+concurrent.futures.Future, so an event driven gateway never blocks on the
+round trips of a request. From asyncio the futures can be awaited with
+asyncio.wrap_future.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_MAX_WORKERS = 10
+
+
+class AsyncGraphAPI(object):
+    def __init__(self, graph_api, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Wraps the graph api, running at most max_workers of its calls at
+        once. Calls beyond that wait in the executor's queue.
+        """
+        self.graph_api = graph_api
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def request_subgraph_at_node(self, actor_id, include_dict, id, node_type=None, breadth_first=False):
+        return self.executor.submit(
+            self.graph_api.request_subgraph_at_node,
+            actor_id, include_dict, id, node_type, breadth_first=breadth_first)
+
+    def query_for_subgraphs(self, actor_id, query_dict, node_type, breadth_first=False):
+        return self.executor.submit(
+            self.graph_api.query_for_subgraphs,
+            actor_id, query_dict, node_type, breadth_first=breadth_first)
+
+    def update_subgraph_at_node(self, actor_id, update_type, update_dict, id=None, node_type=None):
+        return self.executor.submit(
+            self.graph_api.update_subgraph_at_node,
+            actor_id, update_type, update_dict, id, node_type)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
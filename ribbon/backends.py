@@ -0,0 +1,656 @@
+"""
+Storage backends for the GraphAPI.
+
+A backend hands out transactions, and a transaction provides the handful of
+graph operations RibbonGraph is built on. Neo4jBackend implements them with
+Cypher through py2neo. MemoryBackend (in memory_backend.py) implements them
+over in-process indexes.
+"""
+from collections import OrderedDict
+import time
+import py2neo
+import instrumentation
+import query_builder
+from py2neo_additions import ConnectionPool, InstrumentedTransaction
+
+
+class Node(dict):
+    """
+    The properties of a node, with its labels. Missing properties read as
+    None, as they do on py2neo nodes.
+    """
+    def __init__(self, labels, properties):
+        super(Node, self).__init__(properties)
+        self.labels = list(labels)
+
+    def __missing__(self, key):
+        return None
+
+
+class GraphBackend(object):
+    """
+    The interface every storage backend implements.
+    """
+
+    # Whether transactions of the backend can run statements compiled by the
+    # SubgraphQueryCompiler. Backends which can't are read breadth first.
+    supports_compiled_queries = False
+
+    def begin(self):
+        """
+        Returns a new GraphTransaction.
+        """
+        raise NotImplementedError()
+
+    def transaction(self):
+        """
+        Returns a context manager for a new transaction, which is committed
+        when the block succeeds and rolled back when it raises.
+        """
+        return TransactionManager(self)
+
+    def adopt(self, tx):
+        """
+        Returns tx as a GraphTransaction of this backend. Lets callers pass
+        in transactions they began themselves.
+        """
+        return tx
+
+    def reserve_id_block(self, block_size):
+        """
+        Reserves block_size new node ids, returning the last one.
+        """
+        raise NotImplementedError()
+
+    def setup_constraints(self):
+        pass
+
+    def remove_constraints(self):
+        pass
+
+    def create_index(self, label, property_name):
+        """
+        Indexes the property of the nodes with the label, if the storage has
+        indexes. Creating an index which exists does nothing.
+        """
+        pass
+
+    def label_existing_nodes(self, labels, batch_size):
+        return 0
+
+    def ping(self):
+        """
+        Raises if the storage can not be reached.
+        """
+        pass
+
+
+class GraphTransaction(object):
+    """
+    The operations of a single transaction. Nodes are returned as mappings
+    from property names to values which give None for missing properties.
+    """
+
+    def commit(self):
+        raise NotImplementedError()
+
+    def rollback(self):
+        raise NotImplementedError()
+
+    def after_commit(self, callback):
+        """
+        Calls callback once the transaction has committed, for work which
+        must not happen before its changes are visible.
+        """
+        raise NotImplementedError()
+
+    def flush(self):
+        """
+        Hands any writes the transaction is holding back to the underlying
+        transaction, for a caller which commits that transaction itself.
+        """
+        pass
+
+    def get_node_labels(self, id):
+        """
+        Returns the model labels of the node, or None if there is no node
+        with the id.
+        """
+        raise NotImplementedError()
+
+    def get_node(self, id, label=None):
+        """
+        Returns the node with the id, if it has the label when one is given,
+        or None.
+        """
+        raise NotImplementedError()
+
+    def get_nodes(self, label, constraints=None, limit=100, skip=0, order_by=None, after=None, properties=None):
+        """
+        Returns a page of the nodes with the label. Unless after is None the
+        page is a keyset page, see cursors, which starts after the (value,
+        id) position after, or at the start if after is empty.
+
+        If a list of property names is given the nodes returned may have
+        only those properties and their id.
+        """
+        raise NotImplementedError()
+
+    def get_related_nodes(self, relationship, from_node_id, constraints=None, limit=100, skip=0, order_by=None,
+                          after=None, properties=None):
+        raise NotImplementedError()
+
+    def get_related_nodes_for_ids(self, requests):
+        """
+        Takes a list of (relationship, from_node_ids, constraints, limit, skip,
+        order_by, after, properties) requests and returns, for each of them, a
+        dict mapping each of the from_node_ids to its list of (node,
+        node_type) pairs. The from_node_ids may repeat.
+        """
+        raise NotImplementedError()
+
+    def edge_exists(self, rel_type, a_id, b_id, directed=False):
+        raise NotImplementedError()
+
+    def add_edge(self, relationship, from_node_id, to_node_id):
+        raise NotImplementedError()
+
+    def remove_edge(self, relationship, from_node_id, to_node_id):
+        raise NotImplementedError()
+
+    def set_attribute(self, attribute, id, value):
+        raise NotImplementedError()
+
+    def create_node(self, labels, properties):
+        raise NotImplementedError()
+
+    def delete_node(self, id):
+        raise NotImplementedError()
+
+    # Batched forms of the operations above. Backends which can do better
+    # than one operation at a time override them.
+
+    def get_nodes_by_ids(self, ids):
+        """
+        Returns a dict mapping each of the ids which belongs to a node to
+        that node.
+        """
+        nodes = {}
+        for id in ids:
+            node = self.get_node(id)
+            if node is not None:
+                nodes[id] = node
+        return nodes
+
+    def existing_edges(self, relationship, pairs):
+        """
+        Returns the set of the (from_node_id, to_node_id) pairs which are
+        already related by the relationship.
+        """
+        existing = set()
+        for from_node_id, to_node_id in pairs:
+            if relationship.direction == 'incoming':
+                exists = self.edge_exists(relationship.rel_type, to_node_id, from_node_id, directed=True)
+            else:
+                exists = self.edge_exists(
+                    relationship.rel_type, from_node_id, to_node_id, directed=relationship.direction == 'outgoing')
+            if exists:
+                existing.add((from_node_id, to_node_id))
+        return existing
+
+    def create_nodes(self, labels, properties_list):
+        for properties in properties_list:
+            self.create_node(labels, properties)
+
+    def set_properties(self, updates):
+        """
+        Takes a list of (id, properties) pairs and sets the properties on the
+        node with each id.
+        """
+        for id, properties in updates:
+            for name, value in properties.iteritems():
+                self.set_attribute(_NamedAttribute(name), id, value)
+
+    def add_edges(self, relationship, pairs):
+        for from_node_id, to_node_id in pairs:
+            self.add_edge(relationship, from_node_id, to_node_id)
+
+    def delete_nodes(self, ids):
+        for id in ids:
+            self.delete_node(id)
+
+    def delete_edges_of_nodes(self, ids, limit):
+        """
+        Deletes at most limit of the edges of the nodes with the ids and
+        returns how many were deleted. Backends whose delete_node is cheap
+        for nodes with many edges need not delete any.
+        """
+        return 0
+
+
+class _NamedAttribute(object):
+    """
+    Stands in for an Attribute where only its name is needed.
+    """
+    def __init__(self, name):
+        self.name = name
+
+
+class TransactionManager(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.tx = None
+
+    def __enter__(self):
+        self.tx = self.backend.begin()
+        return self.tx
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.tx.rollback()
+        else:
+            self.tx.commit()
+
+
+class Neo4jBackend(GraphBackend):
+    supports_compiled_queries = True
+
+    def __init__(self, database_url=None, connection_pool=None, node_cache=None):
+        """
+        Transactions begun by the backend share the nodes they read through
+        node_cache, a node_cache.NodeCache, if one is given.
+        """
+        self.neograph = py2neo.Graph() if not database_url else py2neo.Graph(database_url)
+        self.connection_pool = connection_pool or ConnectionPool()
+        self.node_cache = node_cache
+
+    def begin(self):
+        self.connection_pool.acquire()
+        try:
+            return Neo4jTransaction(
+                InstrumentedTransaction(self.neograph.cypher.begin()), self.connection_pool, self.node_cache)
+        except:
+            self.connection_pool.release()
+            raise
+
+    def adopt(self, tx):
+        if isinstance(tx, Neo4jTransaction):
+            return tx
+        if not isinstance(tx, InstrumentedTransaction):
+            tx = InstrumentedTransaction(tx)
+        return Neo4jTransaction(tx)
+
+    def reserve_id_block(self, block_size):
+        # Not bounded by the connection pool: blocks are reserved while
+        # transactions holding connections wait for them.
+        statement = query_builder.reserve_id_block()
+        instrumentation.record_statement(statement)
+        start = time.time()
+        last_id = self.neograph.cypher.execute_one(statement, {'block_size': block_size})
+        instrumentation.record_round_trip(time.time() - start, 1)
+        return last_id
+
+    def setup_constraints(self):
+        self.neograph.cypher.execute(query_builder.create_id_constraint())
+        self.neograph.cypher.execute(query_builder.create_id_counter())
+
+    def remove_constraints(self):
+        self.neograph.cypher.execute(query_builder.drop_id_constraint())
+
+    def create_index(self, label, property_name):
+        self.neograph.cypher.execute(query_builder.create_index(label, property_name))
+
+    def label_existing_nodes(self, labels, batch_size):
+        total = 0
+        for label in labels:
+            statement = query_builder.label_unlabeled_nodes(label)
+            while True:
+                labeled = self.neograph.cypher.execute_one(statement, {'batch_size': batch_size})
+                total += labeled
+                if labeled < batch_size:
+                    break
+        return total
+
+    def ping(self):
+        with self.connection_pool.connection():
+            self.neograph.cypher.execute('RETURN 1')
+
+
+class Neo4jTransaction(GraphTransaction):
+    """
+    Wraps a py2neo transaction.
+
+    Writes are held back in a pending batch instead of being sent with the
+    next read. A read flushes the batch (appends it ahead of itself) only if
+    its result could depend on a pending write, otherwise the writes wait and
+    are sent together with the commit. Consecutive property writes to the
+    same node are merged into a single SET.
+
+    Nodes read or created by the transaction are kept, with the transaction's
+    own writes applied, so that reading them again, and in particular
+    reading nodes the transaction created, needs no round trip. Nodes it
+    has not read yet are looked up in the shared node_cache, if there is
+    one, before they are fetched, except for those it wrote, which it
+    invalidates there when it commits.
+
+    append and process are passed through, after flushing, so permission
+    rules may still run their own Cypher on the transaction.
+    """
+    def __init__(self, tx, connection_pool=None, node_cache=None):
+        self.tx = tx
+        self.connection_pool = connection_pool
+        self.node_cache = node_cache
+        self._nodes = {}
+        self._written = set()
+        self._created = set()
+        self._written_rel_types = set()
+        self._pending = []
+        self._pending_properties = {}
+        self._pending_rel_types = set()
+        self._pending_deletes = False
+        self._after_commit = []
+
+    def append(self, statement, parameters=None, **kwparameters):
+        self.flush()
+        return self.tx.append(statement, parameters, **kwparameters)
+
+    def process(self):
+        self.flush()
+        return self.tx.process()
+
+    def flush(self):
+        """
+        Appends the pending writes to the transaction, to be sent along with
+        the next statement processed.
+        """
+        for statement, parameters in self._pending:
+            self.tx.append(statement, parameters)
+        self._pending = []
+        self._pending_properties = {}
+        self._pending_rel_types = set()
+        self._pending_deletes = False
+
+    def commit(self):
+        try:
+            self.flush()
+            result = self.tx.commit()
+        finally:
+            self._release()
+        if self.node_cache is not None and self._written:
+            self._update_node_cache()
+        for callback in self._after_commit:
+            callback()
+        return result
+
+    def rollback(self):
+        try:
+            return self.tx.rollback()
+        finally:
+            self._release()
+
+    def after_commit(self, callback):
+        self._after_commit.append(callback)
+
+    def _release(self):
+        if self.connection_pool:
+            self.connection_pool.release()
+            self.connection_pool = None
+
+    def _update_node_cache(self):
+        # The records of nodes the committed transaction created are
+        # complete, the others it wrote may have been read stale, so only
+        # the former are stored.
+        for id in self._created:
+            node = self._nodes.get(id, None)
+            if node is not None:
+                self.node_cache.put(id, node.labels, node)
+        self.node_cache.invalidate([id for id in self._written if id not in self._created or id not in self._nodes])
+
+    def _cached_node(self, id):
+        """
+        Returns the node with the id from the shared node cache, or None.
+        """
+        if self.node_cache is None or id in self._written:
+            return None
+        record = self.node_cache.get(id)
+        if record is None:
+            return None
+        node = Node(*record)
+        self._nodes[id] = node
+        return node
+
+    def _read(self, statement, parameters):
+        self.tx.append(statement, parameters)
+        return self.tx.process()[-1]
+
+    def _node(self, n):
+        """
+        Returns the transaction's view of a node read from the database.
+        """
+        node = self._nodes.get(n['id'], None)
+        if node is None:
+            node = Node(n.labels, n.properties)
+            self._nodes[node['id']] = node
+            if self.node_cache is not None and node['id'] not in self._written:
+                self.node_cache.put(node['id'], node.labels, node)
+        return node
+
+    def _projected_node(self, row, labels):
+        """
+        Returns the transaction's view of a node of which only some of the
+        properties were read. Such nodes are not kept, since reading the node
+        again must return all of its properties.
+        """
+        node = self._nodes.get(row['id'], None)
+        if node is None:
+            node = Node(labels, row)
+        return node
+
+    def _depends_on_relationships(self, rel_type, constraints=None, order_by=None, after=None):
+        return (self._pending_deletes or rel_type in self._pending_rel_types
+                or (self._pending_properties and (constraints or order_by or after)))
+
+    ######### Reads #########
+
+    def get_node_labels(self, id):
+        node = self.get_node(id)
+        if node is None:
+            return None
+        return [label for label in node.labels if label != query_builder.BASE_LABEL]
+
+    def get_node(self, id, label=None):
+        if id not in self._nodes and self._cached_node(id) is None:
+            if self._pending_deletes or id in self._pending_properties:
+                self.flush()
+            n = self._read(query_builder.node_by_id(), {'id': id}).one
+            if n is None:
+                return None
+            self._node(n)
+        node = self._nodes.get(id, None)
+        if node is None or (label and label not in node.labels):
+            return None
+        return node
+
+    def get_nodes(self, label, constraints=None, limit=100, skip=0, order_by=None, after=None, properties=None):
+        self.flush()
+        if not after or query_builder.keyset_tail_expression(order_by, after) is None:
+            return self._get_nodes(label, constraints, limit, skip, order_by, after, properties)
+        # The section of the ordering the cursor is in (the nodes with or
+        # without a value for the key) is read with a seekable range, and the
+        # section after it only once that runs out.
+        nodes = self._get_nodes(label, constraints, skip + limit, 0, order_by, after, properties)
+        if len(nodes) < skip + limit:
+            nodes += self._get_nodes(
+                label, constraints, skip + limit - len(nodes), 0, order_by, after, properties, tail=True)
+        return nodes[skip:]
+
+    def _get_nodes(self, label, constraints, limit, skip, order_by, after, properties, tail=False):
+        statement, parameters = query_builder.nodes_with_constraints(
+            label, constraints, order_by, after, properties, tail)
+        parameters.update({'skip': skip, 'limit': limit})
+        if properties:
+            return [self._projected_node(r[0], [label]) for r in self._read(statement, parameters)]
+        return [self._node(r[0]) for r in self._read(statement, parameters)]
+
+    def get_related_nodes(self, relationship, from_node_id, constraints=None, limit=100, skip=0, order_by=None,
+                          after=None, properties=None):
+        if from_node_id in self._created and relationship.rel_type not in self._written_rel_types:
+            # A node created by this transaction has no edges but those the
+            # transaction added.
+            return []
+        if self._depends_on_relationships(relationship.rel_type, constraints, order_by, after):
+            self.flush()
+        statement, parameters = query_builder.related_nodes_with_constraints(
+            relationship, constraints, order_by, after, properties)
+        parameters.update({'id': from_node_id, 'skip': skip, 'limit': limit})
+        if properties:
+            return [self._projected_node(r[0], []) for r in self._read(statement, parameters)]
+        return [self._node(r[0]) for r in self._read(statement, parameters)]
+
+    def get_related_nodes_for_ids(self, requests):
+        # All of the requests are sent in a single round trip.
+        if not requests:
+            return []
+        for relationship, from_node_ids, constraints, limit, skip, order_by, after, properties in requests:
+            if self._depends_on_relationships(relationship.rel_type, constraints, order_by, after):
+                self.flush()
+        for relationship, from_node_ids, constraints, limit, skip, order_by, after, properties in requests:
+            statement, parameters = query_builder.related_nodes_for_ids(
+                relationship, constraints, order_by, after, properties)
+            # A node reached along several paths is expanded once, since rows
+            # of a repeated id would be collected into a single page.
+            ids = list(OrderedDict.fromkeys(from_node_ids))
+            parameters.update({'ids': ids, 'skip': skip, 'end': skip + limit})
+            self.tx.append(statement, parameters)
+
+        results = []
+        for request, records in zip(requests, self.tx.process()[-len(requests):]):
+            related_nodes = dict((from_node_id, []) for from_node_id in request[1])
+            for r in records:
+                node = self._projected_node(r[1], [r[2]]) if request[7] else self._node(r[1])
+                related_nodes[r[0]].append((node, r[2]))
+            results.append(related_nodes)
+        return results
+
+    def get_compiled_rows(self, compiled_query, ids):
+        """
+        Runs the compiled statement for each of the ids in a single round
+        trip, returning the row for each id, or None if there is no node
+        with that id.
+        """
+        if not ids:
+            return []
+        self.flush()
+        for id in ids:
+            self.tx.append(compiled_query.statement, compiled_query.parameters_for_id(id))
+        return [records.one for records in self.tx.process()[-len(ids):]]
+
+    def edge_exists(self, rel_type, a_id, b_id, directed=False):
+        if self._depends_on_relationships(rel_type):
+            self.flush()
+        return self._read(query_builder.edge_between(rel_type, directed), {'aid': a_id, 'bid': b_id}).one != None
+
+    def get_nodes_by_ids(self, ids):
+        missing = [id for id in ids if id not in self._nodes and self._cached_node(id) is None]
+        if missing:
+            if self._pending_deletes or any(id in self._pending_properties for id in missing):
+                self.flush()
+            for r in self._read(query_builder.nodes_by_ids(), {'ids': missing}):
+                self._node(r[0])
+        return dict((id, self._nodes[id]) for id in ids if id in self._nodes)
+
+    def existing_edges(self, relationship, pairs):
+        if not pairs:
+            return set()
+        if self._depends_on_relationships(relationship.rel_type):
+            self.flush()
+        rows = [{'aid': from_node_id, 'bid': to_node_id} for from_node_id, to_node_id in pairs]
+        return set((r[0], r[1]) for r in self._read(query_builder.existing_edges(relationship), {'rows': rows}))
+
+    ######### Writes #########
+
+    def create_nodes(self, labels, properties_list):
+        rows = [dict(properties) for properties in properties_list]
+        if not rows:
+            return
+        self._pending.append((query_builder.create_nodes(labels), {'rows': rows}))
+        for properties in rows:
+            self._pending_properties[properties['id']] = properties
+            self._nodes[properties['id']] = Node(labels, properties)
+            self._created.add(properties['id'])
+            self._written.add(properties['id'])
+
+    def set_properties(self, updates):
+        rows = []
+        for id, properties in updates:
+            pending = self._pending_properties.get(id, None)
+            if pending is not None:
+                pending.update(properties)
+            else:
+                row = {'id': id, 'properties': dict(properties)}
+                rows.append(row)
+                self._pending_properties[id] = row['properties']
+            if id in self._nodes:
+                self._nodes[id].update(properties)
+            self._written.add(id)
+        if rows:
+            self._pending.append((query_builder.set_properties_for_rows(), {'rows': rows}))
+
+    def add_edges(self, relationship, pairs):
+        rows = [{'aid': from_node_id, 'bid': to_node_id} for from_node_id, to_node_id in pairs]
+        if not rows:
+            return
+        self._pending.append((query_builder.add_edges(relationship), {'rows': rows}))
+        self._pending_rel_types.add(relationship.rel_type)
+        self._written_rel_types.add(relationship.rel_type)
+
+    def add_edge(self, relationship, from_node_id, to_node_id):
+        self._pending.append((relationship.create_query, {'aid': from_node_id, 'bid': to_node_id}))
+        self._pending_rel_types.add(relationship.rel_type)
+        self._written_rel_types.add(relationship.rel_type)
+
+    def remove_edge(self, relationship, from_node_id, to_node_id):
+        self._pending.append((relationship.remove_query, {'aid': from_node_id, 'bid': to_node_id}))
+        self._pending_rel_types.add(relationship.rel_type)
+        self._written_rel_types.add(relationship.rel_type)
+
+    def set_attribute(self, attribute, id, value):
+        properties = self._pending_properties.get(id, None)
+        if properties is None:
+            properties = {}
+            self._pending.append((query_builder.set_properties_by_id(), {'id': id, 'properties': properties}))
+            self._pending_properties[id] = properties
+        properties[attribute.name] = value
+        if id in self._nodes:
+            self._nodes[id][attribute.name] = value
+        self._written.add(id)
+
+    def create_node(self, labels, properties):
+        properties = dict(properties)
+        self._pending.append((query_builder.create_node(labels), {'properties': properties}))
+        # Properties set before the node is sent are sent along with it.
+        self._pending_properties[properties['id']] = properties
+        self._nodes[properties['id']] = Node(labels, properties)
+        self._created.add(properties['id'])
+        self._written.add(properties['id'])
+
+    def delete_node(self, id):
+        self._pending.append((query_builder.delete_node_by_id(), {'id': id}))
+        self._pending_properties.pop(id, None)
+        self._pending_deletes = True
+        self._nodes.pop(id, None)
+        self._written.add(id)
+
+    def delete_nodes(self, ids):
+        if not ids:
+            return
+        self._pending.append((query_builder.delete_nodes_by_ids(), {'ids': list(ids)}))
+        self._pending_deletes = True
+        for id in ids:
+            self._pending_properties.pop(id, None)
+            self._nodes.pop(id, None)
+            self._written.add(id)
+
+    def delete_edges_of_nodes(self, ids, limit):
+        self.flush()
+        return self._read(query_builder.delete_edges_of_nodes(), {'ids': list(ids), 'limit': limit}).one
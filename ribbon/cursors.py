@@ -0,0 +1,75 @@
+"""
+Opaque cursors for keyset pagination.
+
+A page read with an `after` cursor is ordered by its order_by key, or by id
+when it has none, with the id breaking ties, and starts right after the
+position in that ordering the cursor encodes. Unlike SKIP, which makes Neo4j
+read and discard every row before the page, a cursor lets it seek to the
+position, through an index on the order_by key when there is one.
+
+Cursors are the url safe base64 of [key, value, id] for the last node of a
+page. An empty cursor asks for the first page.
+"""
+import base64
+import json
+from exceptions import InvalidValueError
+
+
+# The key of a tree under which the next cursors of its related node lists
+# are returned, which no attribute or relationship may be named.
+NEXT_CURSORS_KEY = 'next_cursors'
+
+
+class Page(list):
+    """
+    A list of trees along with the cursor of the page after it, or None if
+    there is no further page or the list was not read with a cursor.
+    """
+    def __init__(self, items=(), next_cursor=None):
+        super(Page, self).__init__(items)
+        self.next_cursor = next_cursor
+
+
+def _key(order_by):
+    return order_by[0] if order_by else 'id'
+
+
+def position(node, order_by=None):
+    """
+    Returns the (value, id) position of the node in the keyset ordering.
+    """
+    return (node[_key(order_by)], node['id'])
+
+
+def encode_cursor(node, order_by=None):
+    value, id = position(node, order_by)
+    return base64.urlsafe_b64encode(json.dumps([_key(order_by), value, id])).rstrip('=')
+
+
+def decode_cursor(cursor, order_by=None):
+    """
+    Returns the (value, id) position the cursor encodes, () for an empty
+    cursor or None for no cursor at all.
+    """
+    if cursor is None:
+        return None
+    if not cursor:
+        return ()
+    try:
+        key, value, id = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise InvalidValueError("Invalid cursor.")
+    if key != _key(order_by):
+        raise InvalidValueError("The cursor was not made for this ordering.")
+    return (value, id)
+
+
+def next_cursor(nodes, limit, order_by=None, after=None):
+    """
+    Returns the cursor of the page after nodes, a page of at most limit
+    nodes read after the position after, or None if nodes is the last page
+    or was not read with a cursor.
+    """
+    if after is None or not nodes or len(nodes) < limit:
+        return None
+    return encode_cursor(nodes[-1], order_by)
@@ -1,18 +1,25 @@
+import query_builder
+
+
 def constraints_expression_from_constraints(constraints, node_identifier="n"):
-    neo4j_operator_mapping = {'!=': '<>', '=': '=', '<': '<', '>': '>', '>=': '>=', '<=': '<=', 'matches': '=~', }
+    """
+    Returns the where expression for the constraints with every value inlined
+    as a literal. Statements sent by the GraphAPI use the parameterized
+    query_builder.constraints_expression instead.
+    """
     expression = ""
     for i, or_constraint in enumerate(constraints):
         for j, and_constraint in enumerate(or_constraint):
             attribute_name, operator, value = and_constraint
-            node_attribute_string = "{}.{}".format(node_identifier, attribute_name)
+            node_attribute_string = "{}.{}".format(node_identifier, query_builder.identifier(attribute_name))
             try:
                 value = int(value)
                 value = str(value)
             except ValueError:
                 # Value is a string. Quote it.
-                value = ''.join(["'", value, "'"])
+                value = ''.join(["'", value.replace("\\", "\\\\").replace("'", "\\'"), "'"])
 
-            expression += ' '.join([node_attribute_string, neo4j_operator_mapping[operator], value])
+            expression += ' '.join([node_attribute_string, query_builder.NEO4J_OPERATOR_MAPPING[operator], value])
             if j < len(or_constraint) - 1:
                 expression += " AND "
         if i < len(constraints) - 1:
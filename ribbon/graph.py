@@ -1,36 +1,124 @@
 from exceptions import (
     NodeNotFoundError, NodeTypeNotFoundError, GraphAPIError, MissingNodeTypeError, InvalidPropertyError,
     MalformedUpdateDictionaryError, )
-import py2neo
-import cypher_utils
-from py2neo_additions import CypherTransactionManager
-from node_model import Attribute, Relationship, NodeModel
+import cursors
+import instrumentation
+import query_builder
+from instrumentation import process_metrics
+from py2neo_additions import ConnectionPool
+from backends import Neo4jBackend
+from node_model import Attribute, Relationship, NodeModel, PermissionCache
+from query_compiler import (
+    SubgraphQueryCompiler, CompilationError, DEFAULT_LIMIT, DEFAULT_SKIP, DEFAULT_CONSTRAINTS, )
+from plan_cache import LRUCache
+from listeners import ListenerDispatcher
+from index_advisor import IndexAdvisor
+from subgraph_cache import touched_node_ids
+from id_allocator import BlockIdAllocator, DEFAULT_ID_BLOCK_SIZE
+from collections import OrderedDict
 from datetime import datetime
 import logging
 import inspect
+import weakref
+import time
 
 
-DEFAULT_LIMIT = 100
-DEFAULT_SKIP = 0
-DEFAULT_CONSTRAINTS = None
+# The number of trees update_subgraphs writes in one transaction.
+DEFAULT_UPDATE_CHUNK_SIZE = 500
+# The number of nodes, and of their edges, delete_nodes deletes in one
+# transaction.
+DEFAULT_DELETE_CHUNK_SIZE = 1000
+DEFAULT_EDGE_DELETE_CHUNK_SIZE = 10000
+# The number of trees stream_subgraphs requests at once.
+DEFAULT_STREAM_BATCH_SIZE = 20
+
+
+def _merge_did_set(queued_args, args):
+    # A did_set still waiting to run reports the value before the first of
+    # the merged changes and after the last.
+    graph, actor_id, node_id, old_value, new_value = args
+    return (graph, actor_id, node_id, queued_args[3], new_value)
 
 
 class GraphAPI(object):
-    def __init__(self, database_url=None, models=[]):
+    def __init__(self, database_url=None, models=[], id_block_size=DEFAULT_ID_BLOCK_SIZE, max_connections=None,
+                 backend=None, instrumentation=None, listener_dispatcher=None, subgraph_cache=None,
+                 node_cache=None, index_advisor=None):
         """
         Initializes the graph with the models that make up the schema graph and
-        an identifier for a url to a neo4j database.
+        an identifier for a url to a neo4j database. New node ids are reserved
+        from the database id_block_size at a time, and at most max_connections
+        requests are sent to the database at once.
+
+        A GraphBackend other than Neo4j, such as a MemoryBackend, may be given
+        as the backend instead of a url. Otherwise the nodes read from Neo4j
+        are shared between requests through node_cache, a
+        node_cache.NodeCache, if one is given.
+
+        The metrics of every request are reported to instrumentation, which
+        defaults to the process wide instrumentation.process_metrics.
+
+        Listeners which opt in with listeners.run_async are run after updates
+        by the background workers of listener_dispatcher.
+
+        If a subgraph_cache, see subgraph_cache, is given the trees returned
+        by request_subgraph_at_node are cached in it.
+
+        The properties queries filter and sort on are recorded by
+        index_advisor, see index_advisor, which defaults to an IndexAdvisor
+        of the graph's own.
+
+        GraphAPIs are meant to be long lived, see registry.get_graph_api.
         """
-        self.neograph = py2neo.Graph() if not database_url else py2neo.Graph(database_url)
+        self.database_url = database_url
+        self.instrumentation = instrumentation or process_metrics
+        self.listener_dispatcher = listener_dispatcher or ListenerDispatcher()
+        self.subgraph_cache = subgraph_cache
+        self.index_advisor = index_advisor or IndexAdvisor()
+        self.connection_pool = ConnectionPool(max_connections)
+        self.backend = backend or Neo4jBackend(database_url, self.connection_pool, node_cache)
+        self.neograph = getattr(self.backend, 'neograph', None)
+        self.id_allocator = BlockIdAllocator(self.backend, id_block_size)
         self.models_dict = {}
         for model in models:
             self.models_dict[model.__name__] = model
+            model.compile_schema()
 
-    def setup_constraints(self):
+        # Relationships whose target model is not in the schema are left out
+        # and looked up (and rejected) when they are used.
+        self.reverse_relationships = {}
+        for model in models:
+            for relationship in model.relationships().values():
+                try:
+                    self.reverse_relationships[relationship] = relationship.get_reverse_relationship(self.models_dict)
+                except NodeTypeNotFoundError:
+                    pass
+        self.query_compiler = SubgraphQueryCompiler(self.models_dict)
+        self.compiled_query_cache = LRUCache()
+        self._permission_caches = weakref.WeakKeyDictionary()
+
+    def setup_constraints(self, create_recommended_indexes=False):
         """
         Creates constraints for the graph based on the models in the schema
-        graph.
+        graph, including the uniqueness constraint (and with it the index)
+        on the id of every node, and the indexes of the attributes declared
+        indexed. If create_recommended_indexes is set the indexes the index
+        advisor recommends are created as well.
         """
+        self.backend.setup_constraints()
+        indexes = []
+        for node_type, node_model in self.models_dict.iteritems():
+            for name, attribute in node_model.attributes().iteritems():
+                if getattr(attribute, 'indexed', False):
+                    indexes.append((node_type, name))
+        if create_recommended_indexes:
+            indexes.extend(self.index_advisor.recommendations())
+        for node_type, name in indexes:
+            self.backend.create_index(node_type, name)
+            self.index_advisor.add_index(node_type, name)
+
+        if not self.neograph:
+            return
         for node_type in self.models_dict.values():
             if hasattr(node_type, "add_constraints_to_graph"):
                 node_type.add_constraints_to_graph(self.neograph)
@@ -39,43 +127,191 @@ class GraphAPI(object):
         """
         Removes all of the constraints set by the models in the schema graph.
         """
+        self.backend.remove_constraints()
+        if not self.neograph:
+            return
         for node_type in self.models_dict.values():
             if hasattr(node_type, "remove_constraints_from_graph"):
                 node_type.remove_constraints_from_graph(self.neograph)
 
-    def query_for_subgraphs(self, actor_id, query_dict, node_type):
+    def warm_up(self):
+        """
+        Opens a connection to the database ahead of the first request.
+        """
+        self.backend.ping()
+
+    def health_check(self):
+        """
+        Returns whether the database is reachable, how long a trivial
+        statement took and the usage of the connection pool.
+        """
+        health = {'url': self.database_url, 'pool': self.connection_pool.stats()}
+        start = time.time()
+        try:
+            self.backend.ping()
+        except Exception as e:
+            health['healthy'] = False
+            health['error'] = str(e)
+        else:
+            health['healthy'] = True
+        health['latency'] = time.time() - start
+        return health
+
+    def label_existing_nodes(self, batch_size=10000):
+        """
+        Migrates nodes created before every node was given the base label, so
+        that they can be found by id. Nodes are labeled in separate batches of
+        at most batch_size to keep each transaction small. Returns the number
+        of nodes labeled.
+        """
+        return self.backend.label_existing_nodes(self.models_dict.keys(), batch_size)
+
+    def query_for_subgraphs(self, actor_id, query_dict, node_type, breadth_first=False):
         """
         This is used for returning a tree formatted subgraph of API where the
         query dict specifies which nodes should match the query and which
         relationships should be included for each node matching the query.
 
+        The matching nodes and all of their trees are read in one transaction.
+        The trees are requested together, either as one batch of compiled
+        statements or, if breadth_first is set or the include dict can not be
+        compiled, by expanding them together one depth level at a time.
+
+        The trees are returned as a cursors.Page. If the query dict has an
+        `after` cursor the nodes are read as a keyset page, and the cursor of
+        the next page is set on the Page.
         """
         skip = query_dict.get('skip', DEFAULT_SKIP)
         order_by = query_dict.get('order_by', None)
         limit = query_dict.get('limit', DEFAULT_LIMIT)
         constraints = query_dict.get('where', DEFAULT_CONSTRAINTS)
         include_dict = query_dict.get('include', None)
-        nodes = self._get_nodes_with_constraints(node_type, constraints, limit, skip, order_by)
-        results = []
-        for node in nodes:
-            results.append(self.request_subgraph_at_node(actor_id, include_dict, node['id'], node_type))
-        return results
+        after = cursors.decode_cursor(query_dict.get('after', None), order_by)
+        node_model = self.models_dict.get(node_type, None)
+        if not node_model:
+            raise NodeTypeNotFoundError(node_type)  # No query injections please.
+
+        with self.instrumentation.request('query_for_subgraphs'), self.backend.transaction() as tx:
+            nodes = self._get_nodes_with_constraints(
+                node_type, constraints, limit, skip, order_by, after,
+                self._read_properties(node_model, include_dict, order_by), tx=tx)
+            trees = self._request_subgraphs(tx, actor_id, include_dict, nodes, node_model, breadth_first)
+            return cursors.Page(trees, cursors.next_cursor(nodes, limit, order_by, after))
+
+    def stream_subgraphs(self, actor_id, query_dict, node_type, breadth_first=False,
+                         batch_size=DEFAULT_STREAM_BATCH_SIZE):
+        """
+        Streaming form of query_for_subgraphs, which yields the trees one at
+        a time instead of returning a list. The matching nodes are read
+        batch_size at a time, and the trees of a batch are requested together
+        only when the previous batch has been consumed, so that at most one
+        batch of trees is held in memory. See streaming.iter_json to send
+        them as a streaming response.
+
+        Every batch is read in a transaction of its own, so no connection is
+        held while the trees are being consumed, and is a keyset page which
+        starts after the last node of the batch before it, so that batches
+        neither overlap nor miss nodes whatever the order_by; skip only
+        applies to the first. Batches may see changes committed between
+        them.
+        """
+        skip = query_dict.get('skip', DEFAULT_SKIP)
+        order_by = query_dict.get('order_by', None)
+        limit = query_dict.get('limit', DEFAULT_LIMIT)
+        constraints = query_dict.get('where', DEFAULT_CONSTRAINTS)
+        include_dict = query_dict.get('include', None)
+        after = cursors.decode_cursor(query_dict.get('after', None), order_by)
+        if after is None:
+            after = ()
+        node_model = self.models_dict.get(node_type, None)
+        if not node_model:
+            raise NodeTypeNotFoundError(node_type)  # No query injections please.
 
-    def update_subgraphs(self, actor_id, update_list):
+        offset = 0
+        while offset < limit:
+            batch_limit = min(batch_size, limit - offset)
+            batch_skip = 0 if offset else skip
+            with self.instrumentation.request('stream_subgraphs'), self.backend.transaction() as tx:
+                nodes = self._get_nodes_with_constraints(
+                    node_type, constraints, batch_limit, batch_skip, order_by, after,
+                    self._read_properties(node_model, include_dict, order_by), tx=tx)
+                trees = self._request_subgraphs(tx, actor_id, include_dict, nodes, node_model, breadth_first)
+            for tree in trees:
+                yield tree
+            if len(nodes) < batch_limit:
+                return
+            offset += len(nodes)
+            after = cursors.position(nodes[-1], order_by)
+
+    def update_subgraphs(self, actor_id, update_list, chunk_size=DEFAULT_UPDATE_CHUNK_SIZE):
         """
-        Updates/creates a forest of trees specified in the update list.
+        Updates/creates a forest of trees specified in the update list. Each
+        update is a dict of the arguments of update_subgraph_at_node, that is
+        an update_type, an update_dict and an id or node_type.
+
+        Flat trees, which only set attributes and attach existing nodes to to
+        many relationships, are grouped by shape and applied chunk_size trees
+        at a time, each chunk in one transaction with one statement per kind
+        of write. Permission rules of a chunk see the graph as it was before
+        the chunk. Any other tree is applied on its own, as by
+        update_subgraph_at_node.
+
+        Returns a list with, for each update, a dict with 'success' and
+        either the 'result' of the update or its 'error'.
         """
+        with self.instrumentation.request('update_subgraphs'):
+            results = [None] * len(update_list)
+            groups = OrderedDict()
+            for index, update in enumerate(update_list):
+                try:
+                    shape = self._bulk_update_shape(update)
+                except GraphAPIError as e:
+                    results[index] = self._failed_update(e)
+                    continue
+                if shape:
+                    groups.setdefault(shape, []).append(index)
+                    continue
+                try:
+                    results[index] = self._succeeded_update(self.update_subgraph_at_node(
+                        actor_id,
+                        update.get('update_type', None),
+                        update.get('update_dict', {}),
+                        update.get('id', None),
+                        update.get('node_type', None)))
+                except GraphAPIError as e:
+                    results[index] = self._failed_update(e)
+
+            for shape, indices in groups.iteritems():
+                for start in xrange(0, len(indices), chunk_size):
+                    chunk = [(index, update_list[index]) for index in indices[start:start + chunk_size]]
+                    self._bulk_update_chunk(actor_id, shape[0], chunk, results)
+            return results
 
-    def request_subgraph_at_node(self, actor_id, include_dict, id, node_type=None, tx=None):
+    def request_subgraph_at_node(self, actor_id, include_dict, id, node_type=None, tx=None, breadth_first=False):
         """
         Returns a tree subgraph of the Graph API rooted at the specified node,
         which includes attributes as specified in the include_dict.
-        """
-        if tx:
-            return self._request_subgraph_at_node(tx, actor_id, include_dict, id, node_type)
 
-        with CypherTransactionManager(self.neograph.cypher) as tx:
-            return self._request_subgraph_at_node(tx, actor_id, include_dict, id, node_type)
+        Trees requested outside of a transaction are served from the
+        subgraph cache of the graph, if it has one.
+        """
+        with self.instrumentation.request('request_subgraph_at_node'):
+            if tx:
+                tx = self.backend.adopt(tx)
+                return self._request_subgraph_at_node(tx, actor_id, include_dict, id, node_type, breadth_first)
+
+            if self.subgraph_cache:
+                results = self.subgraph_cache.get(actor_id, id, node_type, include_dict)
+                if results is not None:
+                    return results
+                epoch = self.subgraph_cache.epoch()
+
+            with self.backend.transaction() as tx:
+                results = self._request_subgraph_at_node(tx, actor_id, include_dict, id, node_type, breadth_first)
+
+            if self.subgraph_cache:
+                self.subgraph_cache.put(actor_id, id, node_type, include_dict, results, epoch)
+            return results
 
     def update_subgraph_at_node(self, actor_id, update_type, update_dict, id=None, node_type=None, tx=None):
         """
@@ -83,48 +319,63 @@ class GraphAPI(object):
         specified node, by making the modifications specified in the
         update_dict. All modifications are atomic/transactional.
         """
-        change_stack = []
-        if tx:
-            results = self._update_subgraph_at_node(tx, actor_id, update_type, update_dict, id, node_type, change_stack)
-
-        with CypherTransactionManager(self.neograph.cypher) as tx:
-            results = self._update_subgraph_at_node(tx, actor_id, update_type, update_dict, id, node_type, change_stack)
-            self.assert_allows_updates(actor_id, change_stack, tx)
-
-        # Execute listeners outside the transaction because these listeners
-        # operate under the assumption that the update has been committed.
-        for change in change_stack:
-            if isinstance(change[0], Attribute):
-                attribute = change[0]
-                node_id = change[1]
-                old_value = change[2]
-                new_value = change[3]
-                attribute.did_set(self, actor_id, node_id, old_value, new_value)
-
-            if isinstance(change[0], Relationship):
-                relationship = change[0]
-                node_id = change[1]
-                related_node_id = change[2]
-                change_type = change[3]
-                if change_type == 'remove':
-                    relationship.did_remove_edge(self, actor_id, node_id, related_node_id)
+        with self.instrumentation.request('update_subgraph_at_node'):
+            change_stack = []
+            if tx:
+                adopted = self.backend.adopt(tx)
+                results = self._update_subgraph_at_node(
+                    adopted, actor_id, update_type, update_dict, id, node_type, change_stack)
+                self.assert_allows_updates(actor_id, change_stack, adopted)
+                # The caller commits the transaction it passed, not the
+                # wrapper adopting it, so the held back writes must reach it.
+                adopted.flush()
+                if adopted is tx:
+                    # A tree read before the changes are visible would be
+                    # cached as fresh if they were invalidated any earlier.
+                    tx.after_commit(lambda: self._invalidate_subgraphs(change_stack))
                 else:
-                    relationship.did_add_edge(self, actor_id, node_id, related_node_id)
-
-        return results
+                    # There is no telling when a py2neo transaction commits,
+                    # so trees read until then are only as fresh as the
+                    # timeout of the cache.
+                    self._invalidate_subgraphs(change_stack)
+            else:
+                with self.backend.transaction() as tx:
+                    results = self._update_subgraph_at_node(
+                        tx, actor_id, update_type, update_dict, id, node_type, change_stack)
+                    self.assert_allows_updates(actor_id, change_stack, tx)
+                self._invalidate_subgraphs(change_stack)
+
+            # Execute listeners outside the transaction because these listeners
+            # operate under the assumption that the update has been committed.
+            self._run_listeners(actor_id, change_stack)
+            return results
 
     def assert_allows_updates(self, actor_id, change_stack, tx):
         if actor_id == -1:
             return
+        with instrumentation.timing('permission'):
+            self._assert_allows_updates(actor_id, change_stack, tx)
+
+    def _assert_allows_updates(self, actor_id, change_stack, tx):
+        """
+        Groups the changes by what allows them, so that each rule is checked
+        once for all of the nodes it applies to, and reads the creators of all
+        of the changed nodes in one query first.
+        """
+        created_models = OrderedDict()
+        deleted_ids = OrderedDict()
+        writes = OrderedDict()
+        added_edges = OrderedDict()
+        removed_edges = OrderedDict()
         for change in change_stack:
             if inspect.isclass(change[0]) and issubclass(change[0], NodeModel):
                 node_model = change[0]
                 change_type = change[1]
                 if change_type == 'delete':
                     node_id = change[2]
-                    node_model.assert_allows_delete(actor_id, self, node_id, tx=tx)
+                    deleted_ids.setdefault(node_model, []).append(node_id)
                 else:
-                    node_model.assert_allows_create(actor_id, self, tx=tx)
+                    created_models[node_model] = True
 
             if isinstance(change[0], Attribute):
                 attribute = change[0]
@@ -132,63 +383,331 @@ class GraphAPI(object):
                 old_value = change[2]
                 new_value = change[3]
                 attribute.validate_value(self, actor_id, node_id, new_value, tx=tx)
-                attribute.assert_allows_write(self, actor_id, node_id, new_value, tx=tx)
+                writes.setdefault(attribute, []).append((node_id, new_value))
 
             if isinstance(change[0], Relationship):
                 relationship = change[0]
                 node_id = change[1]
                 related_node_id = change[2]
                 change_type = change[3]
-                if change_type == 'remove':
-                    relationship.assert_allows_remove_edge(
-                        self,
-                        actor_id,
-                        node_id,
-                        related_node_id,
-                        tx=tx
-                    )
-                else:
-                    relationship.assert_allows_add_edge(
-                        self,
-                        actor_id,
-                        node_id,
-                        related_node_id,
-                        tx=tx
-                    )
+                edges = removed_edges if change_type == 'remove' else added_edges
+                edges.setdefault(relationship, []).append((node_id, related_node_id))
+
+        self._prefetch_creators(tx, [node_id for changes in writes.values() for node_id, _ in changes] +
+                                    [node_id for edges in added_edges.values() + removed_edges.values()
+                                     for node_id, _ in edges])
+
+        for node_model in created_models:
+            node_model.assert_allows_create(actor_id, self, tx=tx)
+        for node_model, node_ids in deleted_ids.iteritems():
+            node_model.assert_allows_deletes(actor_id, self, node_ids, tx=tx)
+        for attribute, changes in writes.iteritems():
+            attribute.assert_allows_writes(self, actor_id, changes, tx=tx)
+        for relationship, edges in removed_edges.iteritems():
+            relationship.assert_allows_remove_edges(self, actor_id, edges, tx=tx)
+        for relationship, edges in added_edges.iteritems():
+            relationship.assert_allows_add_edges(self, actor_id, edges, tx=tx)
+
+    def _prefetch_creators(self, tx, node_ids):
+        creators = self.permission_cache(tx).creators
+        missing = list(set(node_id for node_id in node_ids if node_id not in creators))
+        if missing:
+            for node_id, node in tx.get_nodes_by_ids(missing).iteritems():
+                creators[node_id] = node['created_by']
+
+    def delete_nodes(self, actor_id, ids, chunk_size=DEFAULT_DELETE_CHUNK_SIZE,
+                     edge_chunk_size=DEFAULT_EDGE_DELETE_CHUNK_SIZE):
+        """
+        Deletes the set of nodes which corresponds to the ids provided.
 
+        The nodes and their types are read in one query and permission to
+        delete every one of them is checked, model by model, before anything
+        is deleted. The nodes are then deleted chunk_size at a time, their
+        edges first and edge_chunk_size at a time, each chunk in its own
+        transaction, so that deleting nodes with many edges never builds one
+        huge transaction. The deletion as a whole is therefore not atomic.
 
-    def delete_nodes(self, actor_id, ids):
+        Returns the ids of the deleted nodes.
         """
-        Deletes the set of nodes which corresponds to the ids provided.
+        with self.instrumentation.request('delete_nodes'):
+            ids = list(OrderedDict.fromkeys(ids))
+            with self.backend.transaction() as tx:
+                nodes = tx.get_nodes_by_ids(ids)
+                ids_by_model = OrderedDict()
+                for id in ids:
+                    if id not in nodes:
+                        raise NodeNotFoundError(id)
+                    node_type = self._get_node_type_of_node_with_id(tx, id)
+                    node_model = self.models_dict.get(node_type, None)
+                    if not node_model:
+                        raise NodeTypeNotFoundError(node_type)  # No query injections please.
+                    self.permission_cache(tx).creators[id] = nodes[id]['created_by']
+                    ids_by_model.setdefault(node_model, []).append(id)
+
+                if actor_id != -1:
+                    with instrumentation.timing('permission'):
+                        for node_model, model_ids in ids_by_model.iteritems():
+                            node_model.assert_allows_deletes(actor_id, self, model_ids, tx=tx)
+
+            for start in xrange(0, len(ids), chunk_size):
+                chunk = ids[start:start + chunk_size]
+                while True:
+                    with self.backend.transaction() as tx:
+                        if tx.delete_edges_of_nodes(chunk, edge_chunk_size) < edge_chunk_size:
+                            break
+                with self.backend.transaction() as tx:
+                    tx.delete_nodes(chunk)
+                if self.subgraph_cache:
+                    self.subgraph_cache.invalidate(chunk)
+            return ids
+
+    def permission_cache(self, tx):
         """
+        Returns the PermissionCache for the request being served by the
+        transaction, which lives exactly as long as the transaction does.
+        """
+        cache = self._permission_caches.get(tx, None)
+        if cache is None:
+            cache = self._permission_caches.setdefault(tx, PermissionCache())
+        return cache
 
     ######### Internal methods #########
+    def _invalidate_subgraphs(self, change_stack):
+        # Called once the changes have been committed, or are about to be
+        # by the caller which owns the transaction.
+        if self.subgraph_cache:
+            self.subgraph_cache.invalidate(touched_node_ids(change_stack))
+
+    def _run_listeners(self, actor_id, change_stack):
+        with instrumentation.timing('listener'):
+            for change in change_stack:
+                if isinstance(change[0], Attribute):
+                    attribute = change[0]
+                    node_id = change[1]
+                    old_value = change[2]
+                    new_value = change[3]
+                    self.listener_dispatcher.dispatch(
+                        attribute.did_set,
+                        (self, actor_id, node_id, old_value, new_value),
+                        coalesce_key=node_id,
+                        merge=_merge_did_set)
+
+                if isinstance(change[0], Relationship):
+                    relationship = change[0]
+                    node_id = change[1]
+                    related_node_id = change[2]
+                    change_type = change[3]
+                    # Edge listeners are never merged, but the adds and
+                    # removes of an edge are run in order.
+                    edge = (relationship, node_id, related_node_id)
+                    if change_type == 'remove':
+                        self.listener_dispatcher.dispatch(
+                            relationship.did_remove_edge, (self, actor_id, node_id, related_node_id),
+                            serial_key=edge)
+                    else:
+                        self.listener_dispatcher.dispatch(
+                            relationship.did_add_edge, (self, actor_id, node_id, related_node_id),
+                            serial_key=edge)
+
+    @staticmethod
+    def _succeeded_update(result):
+        return {'success': True, 'result': result}
+
+    @staticmethod
+    def _failed_update(error):
+        failure = {'success': False, 'error': getattr(error, 'detail', str(error))}
+        if hasattr(error, 'status_code'):
+            failure['status_code'] = error.status_code
+        return failure
+
+    def _bulk_update_shape(self, update):
+        """
+        Returns the key by which the update is grouped with updates of the same
+        shape, or None if it can not be applied in bulk.
+        """
+        update_type = update.get('update_type', None)
+        update_dict = update.get('update_dict', {})
+        if not isinstance(update_dict, dict):
+            raise MalformedUpdateDictionaryError('Malformed update dictionary.')
+        node_type = None
+        if update_type == 'create':
+            node_type = update.get('node_type', None)
+            if not node_type or update.get('id', None) is not None:
+                return None
+            if node_type not in self.models_dict:
+                raise NodeTypeNotFoundError(node_type)  # No query injections please.
+        elif update_type != 'update' or update.get('id', None) is None:
+            return None
+
+        for key, value in update_dict.iteritems():
+            if not isinstance(value, dict):
+                continue
+            # The only nested updates applied in bulk attach existing nodes.
+            if value.keys() != ['attach'] or not isinstance(value['attach'], list):
+                return None
+            if any(not isinstance(v, dict) or v.keys() != ['id'] for v in value['attach']):
+                return None
+        return (update_type, node_type, tuple(sorted(update_dict.keys())))
+
+    def _bulk_update_chunk(self, actor_id, update_type, chunk, results):
+        """
+        Applies a chunk of flat updates of the same shape in one transaction,
+        recording the outcome of each in results.
+        """
+        try:
+            with self.backend.transaction() as tx:
+                applied = self._bulk_update(tx, actor_id, update_type, chunk, results)
+        except Exception as e:
+            logging.exception('Bulk update of %s trees failed.', len(chunk))
+            for index, _ in chunk:
+                if results[index] is None or results[index]['success']:
+                    results[index] = self._failed_update(e)
+            return
+
+        for index, change_stack in applied:
+            self._invalidate_subgraphs(change_stack)
+            self._run_listeners(actor_id, change_stack)
+
+    def _bulk_update(self, tx, actor_id, update_type, chunk, results):
+        # Read every node the chunk updates or attaches in one go.
+        ids = set()
+        for _, update in chunk:
+            if update_type == 'update':
+                ids.add(update['id'])
+            for value in update['update_dict'].itervalues():
+                if isinstance(value, dict):
+                    ids.update(v['id'] for v in value['attach'])
+        nodes = tx.get_nodes_by_ids(list(ids))
+        creators = self.permission_cache(tx).creators
+        for id, node in nodes.iteritems():
+            creators[id] = node['created_by']
+
+        # Parse every tree, collecting the edges to attach.
+        parsed = []
+        pairs_by_relationship = OrderedDict()
+        for index, update in chunk:
+            try:
+                if update_type == 'create':
+                    node_type = update['node_type']
+                    node = None
+                    id = None
+                else:
+                    id = update['id']
+                    node = nodes.get(id, None)
+                    if node is None:
+                        raise NodeNotFoundError(id)
+                    node_type = self._get_node_type_of_node_with_id(tx, id)
+                node_model = self.models_dict.get(node_type, None)
+                if not node_model:
+                    raise NodeTypeNotFoundError(node_type)  # No query injections please.
+
+                attributes = []
+                attachments = []
+                for key, value in update['update_dict'].iteritems():
+                    if key == 'id':
+                        continue
+                    elif key in node_model.attributes():
+                        attributes.append((node_model.attributes()[key], value))
+                    elif key in node_model.relationships():
+                        relationship = node_model.relationships()[key]
+                        if not isinstance(value, dict) or relationship.max_edges == 1:
+                            raise MalformedUpdateDictionaryError('Malformed update dictionary.')
+                        related_ids = []
+                        for v in value['attach']:
+                            if v['id'] not in nodes:
+                                raise NodeNotFoundError(v['id'])
+                            related_ids.append(v['id'])
+                        attachments.append((relationship, related_ids))
+                    else:
+                        raise InvalidPropertyError("There is no '{}' property.".format(key))
+            except GraphAPIError as e:
+                results[index] = self._failed_update(e)
+                continue
+            parsed.append((index, node_model, id, node, attributes, attachments))
+            if id is not None:
+                for relationship, related_ids in attachments:
+                    pairs_by_relationship.setdefault(relationship, []).extend((id, r) for r in related_ids)
+
+        existing_edges = dict(
+            (relationship, tx.existing_edges(relationship, pairs))
+            for relationship, pairs in pairs_by_relationship.iteritems())
+
+        # Build the change stack of every tree and check its permissions.
+        created = OrderedDict()
+        updated = []
+        edges = OrderedDict()
+        applied = []
+        for index, node_model, id, node, attributes, attachments in parsed:
+            change_stack = []
+            return_dict = {}
+            if id is None:
+                id = self._get_new_global_unique_id(tx)
+                created_at = datetime.now().isoformat()
+                properties = dict(id=id, created_at=created_at, updated_at=created_at, created_by=actor_id)
+                self.permission_cache(tx).creators[id] = actor_id
+                change_stack.append((node_model, 'create'))
+            else:
+                properties = {}
+
+            for attribute, value in attributes:
+                change_stack.append((attribute, id, node[attribute.name] if node is not None else None, value))
+                properties[attribute.name] = value
+                return_dict[attribute.name] = value
+
+            tree_edges = []
+            for relationship, related_ids in attachments:
+                rev_relationship = self._get_reverse_relationship(relationship)
+                return_list = []
+                for related_id in related_ids:
+                    if (id, related_id) in existing_edges.get(relationship, ()):
+                        continue
+                    change_stack.append((relationship, id, related_id, 'add'))
+                    if rev_relationship:
+                        change_stack.append((rev_relationship, related_id, id, 'add'))
+                    tree_edges.append((relationship, (id, related_id)))
+                    return_list.append({'id': related_id})
+                return_dict[relationship.name] = return_list
+
+            try:
+                self.assert_allows_updates(actor_id, change_stack, tx)
+            except GraphAPIError as e:
+                results[index] = self._failed_update(e)
+                continue
+
+            if node is None:
+                created.setdefault(node_model.__name__, []).append(properties)
+            elif properties:
+                updated.append((id, properties))
+            for relationship, pair in tree_edges:
+                edges.setdefault(relationship, []).append(pair)
+            return_dict['id'] = id
+            results[index] = self._succeeded_update(return_dict)
+            applied.append((index, change_stack))
+
+        for node_type, properties_list in created.iteritems():
+            tx.create_nodes([node_type, query_builder.BASE_LABEL], properties_list)
+        tx.set_properties(updated)
+        for relationship, pairs in edges.iteritems():
+            tx.add_edges(relationship, pairs)
+        return applied
+
+    def _get_reverse_relationship(self, relationship):
+        try:
+            return self.reverse_relationships[relationship]
+        except KeyError:
+            return relationship.get_reverse_relationship(self.models_dict)
+
     def _get_node_type_of_node_with_id(self, tx, id):
-        tx.append('MATCH (n) WHERE n.id = {id} RETURN labels(n)', {'id': id})
-        node = tx.process()[-1].one
-        if not node:
+        labels = tx.get_node_labels(id)
+        if not labels:
             raise NodeNotFoundError(id)
-        return node[0]
+        return labels[0]
 
     def _nodes_are_related_by(self, tx, a_id, b_id, rel_type):
-        tx.append(
-            'MATCH (a {{ id:{aid} }})-[r:{rel_type}]-(b {{ id:{bid} }}) '
-            'RETURN r'.format(
-                aid=a_id,
-                rel_type=rel_type,
-                bid=b_id))
-        results = tx.process()[-1].one
-        return results != None
+        return tx.edge_exists(rel_type, a_id, b_id)
 
     def _nodes_are_related_from_a_to_b_by(self, tx, a_id, b_id, rel_type):
-        tx.append(
-            'MATCH (a {{ id:{aid} }})-[r:{rel_type}]->(b {{ id:{bid} }}) '
-            'RETURN r'.format(
-                aid=a_id,
-                rel_type=rel_type,
-                bid=b_id))
-        results = tx.process()[-1].one
-        return results != None
+        return tx.edge_exists(rel_type, a_id, b_id, directed=True)
 
     def _get_node_with_id(self, tx, id, node_type=None):
         node = None
@@ -197,57 +716,74 @@ class GraphAPI(object):
             if not node_model:
                 # No query injections please.
                 raise NodeTypeNotFoundError(node_type)
-            tx.append('MATCH (n:{node_type}) '
-                      'WHERE n.id = {{id}} '
-                      'RETURN n'.format(node_type=node_type),
-                      {'id': id})
-        else:
-            tx.append('MATCH (n) WHERE n.id = {id} RETURN n', {'id': id})
-        node = tx.process()[-1].one
+        node = tx.get_node(id, node_type)
         if not node:
             raise NodeNotFoundError(id)
+        self.permission_cache(tx).creators[node['id']] = node['created_by']
         return node
 
-    def _get_nodes_with_constraints(self, node_type, constraints, limit, skip, order_by):
-        # TODO: AAAAAHHHH
-        # CYPHER INJECTION POTENTIAL! WATCHOUT!
-        constraint_query = ''
+    def _get_nodes_with_constraints(self, node_type, constraints, limit, skip, order_by, after=None, properties=None,
+                                    tx=None):
         # Node type required otherwise you pick up internal type nodes as well.
-        constraint_query += 'MATCH (n:{})'.format(node_type)
-        if constraints:
-            constraint_query += ' WHERE '
-            constraint_query += cypher_utils.constraints_expression_from_constraints(constraints)
-        constraint_query += ' RETURN n'
+        if node_type not in self.models_dict:
+            raise NodeTypeNotFoundError(node_type)  # No query injections please.
+        if not tx:
+            with self.backend.transaction() as tx:
+                return self._get_nodes_with_constraints(
+                    node_type, constraints, limit, skip, order_by, after, properties, tx=tx)
+
+        start = time.time()
+        nodes = tx.get_nodes(node_type, constraints, limit, skip, order_by, after, properties)
+        if constraints or order_by:
+            self._record_index_usage(node_type, constraints, order_by, time.time() - start)
+        return nodes
+
+    def _record_index_usage(self, node_type, constraints, order_by, duration):
+        # Only attributes of the model are recorded, so that clients can not
+        # get indexes created on arbitrary names.
+        attributes = self.models_dict[node_type].attributes()
+        properties = [constraint[0] for or_constraint in constraints or () for constraint in or_constraint]
         if order_by:
-            constraint_query += ' ORDER BY "{}"'.format(order_by[0])
-            constraint_query += ' {}'.format(order_by[1].upper())
-        constraint_query += ' SKIP {}'.format(skip)
-        constraint_query += ' LIMIT {}'.format(limit)
-        return map(lambda r: r[0], self.neograph.cypher.execute(constraint_query))
+            properties.append(order_by[0])
+        self.index_advisor.record(node_type, [name for name in properties if name in attributes], duration)
+
+    def _read_properties(self, node_model, include_dict, order_by=None):
+        """
+        Internal method
+
+        Returns the properties of the nodes of the model which expanding the
+        include dict reads: the included attributes, the id, the created_by
+        the default permission rules need and the order_by key cursors are
+        made from. Keys which are not relationships are all kept, so that
+        they are rejected as they would be without a projection.
+        """
+        properties = set(['created_by'])
+        if include_dict:
+            relationships = node_model.relationships()
+            properties.update(key for key in include_dict if key not in relationships)
+        if order_by:
+            properties.add(order_by[0])
+        return sorted(properties)
 
     def _get_new_global_unique_id(self, tx):
-        # Create the global unique id node if necessary
-        tx.append(
-            'MERGE (id:_GlobalUniqueId) '
-            'ON CREATE SET id.count = 1 '
-            'ON MATCH SET id.count = id.count + 1 '
-            'RETURN id.count AS generated_id')
-        # Return the id of first result of the last transaction
-        return tx.process()[-1].one
+        # Ids come from blocks reserved outside of tx, so that concurrent
+        # creating transactions don't serialize on the id counter node.
+        return self.id_allocator.next_id()
 
     def _create_node_of_type(self, tx, creator_id, node_type):
         new_id = self._get_new_global_unique_id(tx)
         created_at = datetime.now()
         updated_at = created_at
-        tx.append(
-            py2neo.cypher.CreateNode(
-                node_type,
+        tx.create_node(
+            [node_type, query_builder.BASE_LABEL],
+            dict(
                 id=new_id,
                 created_at=created_at.isoformat(),
                 updated_at=updated_at.isoformat(),
                 created_by=creator_id
             )
         )
+        self.permission_cache(tx).creators[new_id] = creator_id
         return new_id
 
     def _create_node_of_relationship_type(self, tx, actor_id, relationship):
@@ -255,14 +791,16 @@ class GraphAPI(object):
         return self._create_node_of_type(tx, actor_id, relationship.target_model_name)
 
     def _delete_node(self, tx, id):
-        tx.append('MATCH (n) WHERE n.id = {id} DETACH DELETE n', {'id': id})
+        tx.delete_node(id)
 
-    def _request_subgraph_at_node(self, tx, actor_id, include_dict, id, node_type=None):
+    def _request_subgraph_at_node(self, tx, actor_id, include_dict, id, node_type=None, breadth_first=False):
         """
         Internal method
 
-        This method recursively requests the tree of nodes specified in the
-        include dict, if permission is granted for the operation.
+        Requests the tree of nodes specified in the include dict with a single
+        compiled statement, if permission is granted for the operation. Falls
+        back to breadth first expansion when the include dict can not be
+        compiled.
         """
         if not node_type:
             node_type = self._get_node_type_of_node_with_id(tx, id)
@@ -270,53 +808,184 @@ class GraphAPI(object):
         node_model = self.models_dict.get(node_type, None)
         if not node_model:
             raise NodeTypeNotFoundError(node_type)  # No query injections please.
+
+        if not breadth_first:
+            try:
+                return self._request_compiled_subgraphs(tx, actor_id, include_dict, [id], node_model)[0]
+            except CompilationError:
+                pass
+
         node = self._get_node_with_id(tx, id, node_type)
+        return self._expand_subgraphs_breadth_first(tx, actor_id, include_dict, [node], node_model)[0]
 
-        results = {}
-        # Always include the id of the current node.
-        results['id'] = node['id']
-        if not include_dict:
-            return results
+    def _request_subgraphs(self, tx, actor_id, include_dict, nodes, node_model, breadth_first=False):
+        """
+        Internal method
 
-        for include_key in include_dict:
-            if include_key in node_model.attributes():
-                attribute = node_model.attributes()[include_key]
+        Requests the trees rooted at each of the nodes, with the compiled
+        statement for the include dict unless breadth_first is set or it can
+        not be compiled.
+        """
+        if not breadth_first:
+            try:
+                return self._request_compiled_subgraphs(
+                    tx, actor_id, include_dict, [node['id'] for node in nodes], node_model)
+            except CompilationError:
+                pass
+        return self._expand_subgraphs_breadth_first(tx, actor_id, include_dict, nodes, node_model)
+
+    def _request_compiled_subgraphs(self, tx, actor_id, include_dict, ids, node_model):
+        """
+        Internal method
 
-                if actor_id != -1:
-                    attribute.assert_allows_read(self, actor_id, node['id'], tx=tx)
+        Requests the trees rooted at each of the ids with the compiled
+        statement for the include dict, sending the statements for all of the
+        roots in a single round trip. Raises CompilationError if the include
+        dict can not be compiled.
+        """
+        if not self.backend.supports_compiled_queries:
+            raise CompilationError('The backend can not run compiled statements.')
+        compiled_query = self._compile_subgraph_query(node_model, include_dict)
 
-                results[include_key] = node[include_key]
+        creators = self.permission_cache(tx).creators
+        results = []
+        for id, row in zip(ids, tx.get_compiled_rows(compiled_query, ids)):
+            if not row:
+                raise NodeNotFoundError(id)
+            results.append(compiled_query.rebuild(row, creators))
+
+        if actor_id != -1:
+            for tree in results:
+                self._assert_allows_read_subgraph(tx, actor_id, compiled_query.plan, tree)
+        return results
 
-            elif include_key in node_model.relationships():
-                relationship = node_model.relationships()[include_key]
+    def _compile_subgraph_query(self, node_model, include_dict):
+        """
+        Compiles the include dict, reusing the compiled statement when the
+        include dict is frozen (and so hashable), as the query dicts returned
+        by get_query_dict_from_params are.
+        """
+        key = (node_model, include_dict)
+        try:
+            hash(key)
+        except TypeError:
+            return self.query_compiler.compile(node_model, include_dict)
+        return self.compiled_query_cache.get_or_create(
+            key, lambda: self.query_compiler.compile(node_model, include_dict))
+
+    def _assert_allows_read_subgraph(self, tx, actor_id, plan, results):
+        """
+        Applies the read permissions of every attribute and relationship in
+        the plan to the nodes of an already fetched tree.
+        """
+        for key, attribute in plan.attributes:
+            attribute.assert_allows_read(self, actor_id, results['id'], tx=tx)
 
-                nested_query_dict = include_dict[relationship.name]
-                skip = nested_query_dict.get('skip', DEFAULT_SKIP) if nested_query_dict else DEFAULT_SKIP
-                limit = nested_query_dict.get('limit', DEFAULT_LIMIT) if nested_query_dict else DEFAULT_LIMIT
-                order_by = nested_query_dict.get('order_by', None) if nested_query_dict else None
-                constraints = nested_query_dict.get(
-                    'where', DEFAULT_CONSTRAINTS) if nested_query_dict else DEFAULT_CONSTRAINTS
-                nested_include_dict = nested_query_dict.get('include', None) if nested_query_dict else None
+        for key, relationship, nested_plan in plan.relationships:
+            relationship.assert_allows_read(self, actor_id, results['id'], tx=tx)
+            related = results[key]
+            if related is None:
+                continue
+            for related_results in (related if isinstance(related, list) else [related]):
+                self._assert_allows_read_subgraph(tx, actor_id, nested_plan, related_results)
 
-                if actor_id != -1:
-                    relationship.assert_allows_read(self, actor_id, node['id'], tx=tx)
-
-                related_nodes = relationship.get_related_nodes_with_constraints(
-                    tx, node['id'], constraints, limit, skip, order_by)
-                if relationship.max_edges == 1:
-                    results[relationship.name] = None
-                    if related_nodes:
-                        related_node = related_nodes[0]
-                        results[relationship.name] = self._request_subgraph_at_node(
-                            tx, actor_id, nested_include_dict, related_node['id'])
-                else:
-                    results[relationship.name] = []
-                    for related_node in related_nodes:
-                        results[relationship.name].append(self._request_subgraph_at_node(
-                            tx, actor_id, nested_include_dict, related_node['id']))
-            else:
-                raise InvalidPropertyError("There is no '{}' property.".format(include_key))
-        return results
+    def _expand_subgraphs_breadth_first(self, tx, actor_id, include_dict, nodes, node_model):
+        """
+        Internal method
+
+        Expands the include dict for all of the given nodes one depth level
+        at a time, if permission is granted for the operation. Every level
+        costs one query per included relationship and node type rather than
+        one per parent node, and all of the queries of a level are sent in a
+        single round trip. The trees are returned in the order of `nodes`.
+
+        The cursors of the next pages of the related node lists read with an
+        `after` cursor are returned in the `next_cursors` dict of their
+        parent's tree, by relationship name.
+        """
+        creators = self.permission_cache(tx).creators
+        roots = []
+        frontier = []
+        for node in nodes:
+            creators[node['id']] = node['created_by']
+            results = {'id': node['id']}
+            roots.append(results)
+            frontier.append((results, node, node_model, include_dict))
+
+        while frontier:
+            # Nodes reached through the same include dict with the same type
+            # are expanded together.
+            groups = OrderedDict()
+            for entry in frontier:
+                if entry[3]:
+                    groups.setdefault((id(entry[3]), entry[2]), []).append(entry)
+
+            # Permission checks may run queries of their own, so they are all
+            # done before the fetches of the level are appended.
+            fetches = []
+            for (_, node_model), entries in groups.iteritems():
+                include_dict = entries[0][3]
+                for include_key in include_dict:
+                    if include_key in node_model.attributes():
+                        attribute = node_model.attributes()[include_key]
+                        for results, node, _, _ in entries:
+                            if actor_id != -1:
+                                attribute.assert_allows_read(self, actor_id, node['id'], tx=tx)
+                            results[include_key] = node[include_key]
+
+                    elif include_key in node_model.relationships():
+                        relationship = node_model.relationships()[include_key]
+                        if actor_id != -1:
+                            for results, node, _, _ in entries:
+                                relationship.assert_allows_read(self, actor_id, node['id'], tx=tx)
+                        nested_query_dict = include_dict[relationship.name] or {}
+                        after = cursors.decode_cursor(
+                            nested_query_dict.get('after', None), nested_query_dict.get('order_by', None))
+                        target_model = self.models_dict.get(relationship.target_model_name, None)
+                        properties = self._read_properties(
+                            target_model, nested_query_dict.get('include', None),
+                            nested_query_dict.get('order_by', None)) if target_model else None
+                        fetches.append((entries, relationship, nested_query_dict, after, properties))
+                    else:
+                        raise InvalidPropertyError("There is no '{}' property.".format(include_key))
+
+            related_nodes_per_fetch = tx.get_related_nodes_for_ids([
+                (relationship,
+                 [node['id'] for _, node, _, _ in entries],
+                 nested_query_dict.get('where', DEFAULT_CONSTRAINTS),
+                 nested_query_dict.get('limit', DEFAULT_LIMIT),
+                 nested_query_dict.get('skip', DEFAULT_SKIP),
+                 nested_query_dict.get('order_by', None),
+                 after,
+                 properties)
+                for entries, relationship, nested_query_dict, after, properties in fetches])
+
+            frontier = []
+            for fetch, related_nodes in zip(fetches, related_nodes_per_fetch):
+                entries, relationship, nested_query_dict, after, _ = fetch
+                nested_include_dict = nested_query_dict.get('include', None)
+                for results, node, _, _ in entries:
+                    related_results = []
+                    for related_node, related_node_type in related_nodes[node['id']]:
+                        related_node_model = self.models_dict.get(related_node_type, None)
+                        if not related_node_model:
+                            raise NodeTypeNotFoundError(related_node_type)
+                        creators[related_node['id']] = related_node['created_by']
+                        related_results.append({'id': related_node['id']})
+                        frontier.append((related_results[-1], related_node, related_node_model, nested_include_dict))
+
+                    if relationship.max_edges == 1:
+                        results[relationship.name] = related_results[0] if related_results else None
+                    else:
+                        results[relationship.name] = related_results
+                        if after is not None:
+                            next_cursors = results.setdefault(cursors.NEXT_CURSORS_KEY, {})
+                            next_cursors[relationship.name] = cursors.next_cursor(
+                                [related_node for related_node, _ in related_nodes[node['id']]],
+                                nested_query_dict.get('limit', DEFAULT_LIMIT),
+                                nested_query_dict.get('order_by', None),
+                                after)
+        return roots
 
     def _update_subgraph_at_node(self, tx, actor_id, update_type, update_dict, id=None, node_type=None, change_stack=None):
         """
@@ -419,7 +1088,7 @@ class GraphAPI(object):
         """
         relationship_update_type = update_dict.keys()[0]
         update_value = update_dict[relationship_update_type]
-        rev_relationship = relationship.get_reverse_relationship(self.models_dict)
+        rev_relationship = self._get_reverse_relationship(relationship)
 
         # If there is a currently related node, remove it.
         current_related_nodes = relationship.get_related_nodes_with_constraints(tx, node['id'])
@@ -477,7 +1146,7 @@ class GraphAPI(object):
         """
         return_list = []
         for relationship_update_type, update_list in update_dict.iteritems():
-            rev_relationship = relationship.get_reverse_relationship(self.models_dict)
+            rev_relationship = self._get_reverse_relationship(relationship)
 
             if relationship_update_type == 'delete':
                 for update_value in update_list:
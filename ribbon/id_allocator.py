@@ -0,0 +1,40 @@
+"""
+Allocation of the globally unique ids given to new nodes.
+"""
+import threading
+
+
+DEFAULT_ID_BLOCK_SIZE = 100
+
+
+class BlockIdAllocator(object):
+    """
+    A hi/lo style id allocator. Blocks of block_size ids are reserved from
+    the _GlobalUniqueId counter node in their own short transaction and then
+    handed out from memory, so creating transactions never hold the lock on
+    the counter node. Every process reserves its own blocks, so ids stay
+    unique across processes, but they are no longer allocated in creation
+    order and the unused part of a block is skipped when a process exits.
+    """
+    def __init__(self, backend, block_size=DEFAULT_ID_BLOCK_SIZE):
+        if block_size < 1:
+            raise ValueError('block_size must be at least 1.')
+        self.backend = backend
+        self.block_size = block_size
+        self._next_id = 0
+        self._end_id = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            if self._next_id >= self._end_id:
+                self._reserve_block()
+            new_id = self._next_id
+            self._next_id += 1
+            return new_id
+
+    def _reserve_block(self):
+        # The counter holds the last id handed out in any block.
+        last_id = self.backend.reserve_id_block(self.block_size)
+        self._next_id = last_id - self.block_size + 1
+        self._end_id = last_id + 1
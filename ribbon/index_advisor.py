@@ -0,0 +1,96 @@
+"""
+Recommends indexes for the properties clients filter and sort on.
+
+Queries for nodes of a type can filter with where(...) and sort with
+order_by(...) on any attribute, and without an index on the label and
+property Neo4j scans every node with the label to answer them. The
+IndexAdvisor of a GraphAPI records, for every such query, the (label,
+property) pairs it filtered or sorted on and how long it took, and
+recommends indexes for the pairs which are used often and slowly.
+
+Related nodes are reached from a node found by its (indexed) id, so the
+where and order_by of included relationships are not recorded.
+"""
+import threading
+
+
+# A pair is recommended once it has been used by at least this many queries
+# taking this many seconds on average.
+DEFAULT_MIN_QUERIES = 10
+DEFAULT_MIN_MEAN_TIME = 0.01
+
+
+class IndexUsage(object):
+    def __init__(self):
+        self.queries = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.queries if self.queries else 0.0
+
+    def as_dict(self):
+        return {
+            'queries': self.queries,
+            'total_time': self.total_time,
+            'mean_time': self.mean_time,
+            'max_time': self.max_time,
+        }
+
+
+class IndexAdvisor(object):
+    def __init__(self, min_queries=DEFAULT_MIN_QUERIES, min_mean_time=DEFAULT_MIN_MEAN_TIME):
+        self.min_queries = min_queries
+        self.min_mean_time = min_mean_time
+        self.indexed = set()
+        self._usage = {}
+        self._lock = threading.Lock()
+
+    def record(self, label, properties, duration):
+        """
+        Records that a query for nodes with the label filtered or sorted on
+        the properties and took duration seconds.
+        """
+        with self._lock:
+            for name in set(properties):
+                usage = self._usage.get((label, name), None)
+                if usage is None:
+                    usage = self._usage[(label, name)] = IndexUsage()
+                usage.queries += 1
+                usage.total_time += duration
+                usage.max_time = max(usage.max_time, duration)
+
+    def add_index(self, label, property_name):
+        """
+        Notes that the label and property are indexed, so that they are no
+        longer recommended.
+        """
+        with self._lock:
+            self.indexed.add((label, property_name))
+
+    def usage(self):
+        """
+        Returns the usage recorded for every (label, property) pair.
+        """
+        with self._lock:
+            return dict((pair, usage.as_dict()) for pair, usage in self._usage.iteritems())
+
+    def recommendations(self):
+        """
+        Returns the (label, property) pairs which are not indexed and which
+        have been used by at least min_queries queries taking min_mean_time
+        on average, those which took the most time in total first.
+        """
+        with self._lock:
+            pairs = [
+                (usage.total_time, pair) for pair, usage in self._usage.iteritems()
+                if pair not in self.indexed
+                and usage.queries >= self.min_queries
+                and usage.mean_time >= self.min_mean_time
+            ]
+        return [pair for _, pair in sorted(pairs, reverse=True)]
+
+    def reset(self):
+        with self._lock:
+            self._usage = {}
@@ -0,0 +1,250 @@
+"""
+Per request metrics for the GraphAPI.
+
+Every public GraphAPI call runs as a request, which collects a RequestMetrics:
+the statements sent, the round trips made to Neo4j, the rows they returned,
+and the time spent waiting on Neo4j, evaluating permission rules and running
+listeners. The RequestMetrics of the running request is kept per thread, so
+that transactions and permission checks record into it without it being
+passed around, and a GraphAPI call made while another is running on the same
+thread (as Allows.creator does) is counted as part of it.
+
+When a request finishes its metrics are handed to the Instrumentation of the
+GraphAPI. The default, ProcessMetrics, keeps process wide counters and
+histograms which can be read by an exporter through snapshot().
+"""
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+
+# Upper bounds, in seconds, of the buckets of the timing histograms.
+DEFAULT_TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the buckets of the round trips per request histogram.
+DEFAULT_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+# At most this many statements are kept on a RequestMetrics.
+MAX_RECORDED_STATEMENTS = 100
+
+_local = threading.local()
+
+
+def current():
+    """
+    Returns the RequestMetrics of the request running on this thread, or None.
+    """
+    return getattr(_local, 'metrics', None)
+
+
+def record_statement(statement):
+    metrics = current()
+    if metrics:
+        metrics.record_statement(statement)
+
+
+def record_round_trip(duration, rows=0):
+    metrics = current()
+    if metrics:
+        metrics.record_round_trip(duration, rows)
+
+
+@contextmanager
+def timing(category):
+    """
+    Adds the time spent in the block to the permission or listener time of
+    the running request. Blocks nested in a block of the same category are
+    only counted once.
+    """
+    metrics = current()
+    if not metrics or category in metrics._timing:
+        yield
+        return
+    metrics._timing.add(category)
+    start = time.time()
+    try:
+        yield
+    finally:
+        metrics._timing.discard(category)
+        setattr(metrics, category + '_time', getattr(metrics, category + '_time') + time.time() - start)
+
+
+class RequestMetrics(object):
+    """
+    What a single GraphAPI request cost. Times are in seconds.
+    """
+    def __init__(self, operation):
+        self.operation = operation
+        self.statements = []
+        self.statement_count = 0
+        self.round_trips = 0
+        self.rows = 0
+        self.storage_time = 0.0
+        self.permission_time = 0.0
+        self.listener_time = 0.0
+        self.total_time = None
+        self.error = None
+        self.started_at = time.time()
+        self._timing = set()
+
+    @property
+    def python_time(self):
+        if self.total_time is None:
+            return None
+        return self.total_time - self.storage_time
+
+    def record_statement(self, statement):
+        self.statement_count += 1
+        if len(self.statements) < MAX_RECORDED_STATEMENTS:
+            self.statements.append(statement)
+
+    def record_round_trip(self, duration, rows=0):
+        self.round_trips += 1
+        self.rows += rows
+        self.storage_time += duration
+
+    def finish(self, error=None):
+        self.total_time = time.time() - self.started_at
+        self.error = error
+
+    def as_dict(self):
+        return {
+            'operation': self.operation,
+            'statements': self.statement_count,
+            'round_trips': self.round_trips,
+            'rows': self.rows,
+            'total_time': self.total_time,
+            'storage_time': self.storage_time,
+            'python_time': self.python_time,
+            'permission_time': self.permission_time,
+            'listener_time': self.listener_time,
+            'error': self.error,
+        }
+
+    def log_line(self):
+        return ('{operation} statements={statement_count} round_trips={round_trips} rows={rows} '
+                'total_ms={total:.2f} neo4j_ms={storage:.2f} python_ms={python:.2f} '
+                'permission_ms={permission:.2f} listener_ms={listener:.2f}{error}').format(
+                    operation=self.operation,
+                    statement_count=self.statement_count,
+                    round_trips=self.round_trips,
+                    rows=self.rows,
+                    total=(self.total_time or 0.0) * 1000,
+                    storage=self.storage_time * 1000,
+                    python=(self.python_time or 0.0) * 1000,
+                    permission=self.permission_time * 1000,
+                    listener=self.listener_time * 1000,
+                    error=' error={}'.format(self.error) if self.error else '')
+
+
+class Histogram(object):
+    """
+    Counts observations into buckets by upper bound, as Prometheus does.
+    """
+    def __init__(self, buckets=DEFAULT_TIME_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def snapshot(self):
+        """
+        Returns the count and sum and the cumulative count of every bucket.
+        """
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': cumulative, 'count': self.count, 'sum': self.sum}
+
+
+class Instrumentation(object):
+    """
+    Receives the metrics of every request of a GraphAPI. Subclasses override
+    request_started and request_finished.
+    """
+
+    def request_started(self, metrics):
+        pass
+
+    def request_finished(self, metrics):
+        pass
+
+    @contextmanager
+    def request(self, operation):
+        """
+        Runs the block as a request, yielding its RequestMetrics. Within a
+        request already running on this thread the block is part of it.
+        """
+        metrics = current()
+        if metrics:
+            yield metrics
+            return
+        metrics = RequestMetrics(operation)
+        _local.metrics = metrics
+        self.request_started(metrics)
+        error = None
+        try:
+            yield metrics
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _local.metrics = None
+            metrics.finish(error)
+            self.request_finished(metrics)
+
+
+class ProcessMetrics(Instrumentation):
+    """
+    Process wide counters and histograms over all finished requests. If a
+    logger is given every request is also logged at level.
+    """
+    COUNTERS = ('requests', 'errors', 'statements', 'round_trips', 'rows')
+    TIME_HISTOGRAMS = ('total_time', 'storage_time', 'python_time', 'permission_time', 'listener_time')
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = dict((name, 0) for name in self.COUNTERS)
+            self.requests_by_operation = {}
+            self.histograms = dict((name, Histogram()) for name in self.TIME_HISTOGRAMS)
+            self.histograms['round_trips'] = Histogram(DEFAULT_COUNT_BUCKETS)
+
+    def request_finished(self, metrics):
+        with self._lock:
+            self.counters['requests'] += 1
+            self.counters['errors'] += 1 if metrics.error else 0
+            self.counters['statements'] += metrics.statement_count
+            self.counters['round_trips'] += metrics.round_trips
+            self.counters['rows'] += metrics.rows
+            self.requests_by_operation[metrics.operation] = self.requests_by_operation.get(metrics.operation, 0) + 1
+            for name in self.TIME_HISTOGRAMS:
+                self.histograms[name].observe(getattr(metrics, name))
+            self.histograms['round_trips'].observe(metrics.round_trips)
+        if self.logger:
+            self.logger.log(self.level, metrics.log_line())
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'requests_by_operation': dict(self.requests_by_operation),
+                'histograms': dict((name, h.snapshot()) for name, h in self.histograms.iteritems()),
+            }
+
+
+process_metrics = ProcessMetrics()
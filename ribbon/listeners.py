@@ -0,0 +1,199 @@
+"""
+Dispatch of the listeners which run after an update commits.
+
+Listeners run on the request thread unless they opt in, with run_async, to
+being run by the background workers of a ListenerDispatcher. Asynchronous
+calls wait in a bounded queue, where a call with the same coalesce key (the
+same listener, node and attribute for did_set) as one still waiting is
+merged into it and moved to the back of the queue instead of being queued
+again. Calls with the same coalesce or serial key (the same edge for
+did_add_edge and did_remove_edge, which are never merged) run one at a
+time in the order they were queued, so the last change is also the last
+one seen. When the queue is full the request thread waits for room for a while
+and then runs the listener itself, so that a backlog slows writers down
+rather than growing without bound.
+"""
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+
+DEFAULT_LISTENER_WORKERS = 4
+DEFAULT_LISTENER_QUEUE_SIZE = 1000
+# Seconds a request waits for room in a full queue before running the
+# listener itself.
+DEFAULT_LISTENER_QUEUE_TIMEOUT = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+def run_async(listener):
+    """
+    Marks a listener, such as an overridden did_set, as safe to run after the
+    request has returned, on a background worker. Such listeners must not
+    depend on when they run and may see repeated changes merged into one.
+    """
+    listener.run_async = True
+    return listener
+
+
+class ListenerDispatcher(object):
+    def __init__(self,
+                 max_workers=DEFAULT_LISTENER_WORKERS,
+                 max_queue_size=DEFAULT_LISTENER_QUEUE_SIZE,
+                 queue_timeout=DEFAULT_LISTENER_QUEUE_TIMEOUT):
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout
+        self._queue = OrderedDict()
+        self._condition = threading.Condition()
+        self._workers = []
+        self._running = 0
+        self._running_serial_keys = set()
+        self._shutdown = False
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.failed = 0
+        self.overflowed = 0
+        self.peak_queue_size = 0
+        self.wait_time = 0.0
+
+    def dispatch(self, listener, args, coalesce_key=None, merge=None, serial_key=None):
+        """
+        Calls listener(*args), now or on a worker if the listener runs async.
+        A waiting call with the same listener and coalesce_key has its
+        arguments replaced by merge(waiting_args, args), or by args, and
+        takes the place of args in the queue. Calls with the same listener
+        and coalesce_key, or with the same serial_key, never run at once.
+        """
+        if not getattr(listener, 'run_async', False) or self._shutdown:
+            listener(*args)
+            return
+
+        func = getattr(listener, '__func__', listener)
+        key = (func, getattr(listener, '__self__', None), coalesce_key) if coalesce_key is not None else object()
+        if serial_key is None:
+            serial_key = key
+        with self._condition:
+            self.submitted += 1
+            if key in self._queue:
+                _, queued_args, _ = self._queue.pop(key)
+                self._queue[key] = (listener, merge(queued_args, args) if merge else args, serial_key)
+                self.coalesced += 1
+                return
+
+            if len(self._queue) >= self.max_queue_size:
+                start = time.time()
+                deadline = start + self.queue_timeout
+                while len(self._queue) >= self.max_queue_size and time.time() < deadline:
+                    self._condition.wait(deadline - time.time())
+                self.wait_time += time.time() - start
+            if len(self._queue) >= self.max_queue_size:
+                self.overflowed += 1
+                overflow = True
+            else:
+                overflow = False
+                self._queue[key] = (listener, args, serial_key)
+                self.peak_queue_size = max(self.peak_queue_size, len(self._queue))
+                self._start_worker()
+                self._condition.notify()
+
+        if overflow:
+            self._call(listener, args)
+
+    def _start_worker(self):
+        # Called holding the condition. Workers are started as they are
+        # first needed.
+        if len(self._workers) < self.max_workers and len(self._queue) > len(self._workers) - self._running:
+            worker = threading.Thread(target=self._work, name='ribbon-listener-{}'.format(len(self._workers)))
+            worker.daemon = True
+            self._workers.append(worker)
+            worker.start()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                key = self._next_key()
+                while key is None and not (self._shutdown and not self._queue):
+                    self._condition.wait()
+                    key = self._next_key()
+                if key is None:
+                    return
+                listener, args, serial_key = self._queue.pop(key)
+                self._running += 1
+                self._running_serial_keys.add(serial_key)
+                self._condition.notify_all()
+            try:
+                self._call(listener, args)
+            finally:
+                with self._condition:
+                    self._running -= 1
+                    self._running_serial_keys.discard(serial_key)
+                    self._condition.notify_all()
+
+    def _next_key(self):
+        # Called holding the condition. Returns the key of the oldest call
+        # which no call with its serial key is ahead of, or None.
+        blocked = set(self._running_serial_keys)
+        for key, (_, _, serial_key) in self._queue.iteritems():
+            if serial_key not in blocked:
+                return key
+            blocked.add(serial_key)
+        return None
+
+    def _call(self, listener, args):
+        try:
+            listener(*args)
+        except Exception:
+            with self._condition:
+                self.failed += 1
+            logger.exception('Listener %r failed.', listener)
+        else:
+            with self._condition:
+                self.completed += 1
+
+    def drain(self, timeout=None):
+        """
+        Waits until every queued call has run. Returns False if timeout
+        seconds passed first.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            while self._queue or self._running:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers once the queue is empty. Listeners dispatched after
+        shutdown run on the calling thread.
+        """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'workers': len(self._workers),
+                'max_workers': self.max_workers,
+                'queue_size': len(self._queue),
+                'max_queue_size': self.max_queue_size,
+                'peak_queue_size': self.peak_queue_size,
+                'running': self._running,
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'completed': self.completed,
+                'failed': self.failed,
+                'overflowed': self.overflowed,
+                'wait_time': self.wait_time,
+            }
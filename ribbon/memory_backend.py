@@ -0,0 +1,247 @@
+"""
+An in-memory storage backend.
+
+Nodes are kept in a hash index on id, with a set of node ids per label and an
+adjacency list per node id, relationship type and direction, so every
+operation RibbonGraph performs is a handful of dict lookups. It needs no
+database, which makes it suitable for tests and benchmarks, and it is fast
+enough to serve reads as a hot cache in front of Neo4j.
+
+Transactions are serialized: a transaction holds the lock of the graph from
+begin until commit or rollback, and rollback undoes its writes in reverse.
+"""
+from collections import OrderedDict
+import re
+import threading
+from backends import GraphBackend, GraphTransaction, Node
+from query_builder import BASE_LABEL
+
+
+OUTGOING = 'outgoing'
+INCOMING = 'incoming'
+
+
+def _matches(node, constraints):
+    for and_constraints in constraints:
+        if all(_matches_constraint(node, constraint) for constraint in and_constraints):
+            return True
+    return False
+
+
+def _matches_constraint(node, constraint):
+    attribute_name, operator, value = constraint
+    try:
+        value = int(value)
+    except ValueError:
+        pass
+    node_value = node[attribute_name]
+    if node_value is None:
+        # Comparisons with null are never true in Cypher.
+        return False
+    if operator == '=':
+        return node_value == value
+    if operator == '!=':
+        return node_value != value
+    if operator == '<':
+        return node_value < value
+    if operator == '>':
+        return node_value > value
+    if operator == '<=':
+        return node_value <= value
+    if operator == '>=':
+        return node_value >= value
+    if operator == 'matches':
+        return isinstance(node_value, basestring) and re.match('(?:{})\\Z'.format(value), node_value) is not None
+    return False
+
+
+def _page(nodes, constraints, limit, skip, order_by, after=None):
+    if constraints:
+        nodes = [node for node in nodes if _matches(node, constraints)]
+    if after is not None:
+        # Keyset pages are ordered by (key, id), with the id as the key when
+        # there is no order_by.
+        key, direction = order_by or ('id', 'asc')
+        descending = direction == 'desc'
+        position = lambda node: (node[key] is None, node[key], node['id'])
+        nodes = sorted(nodes, key=position, reverse=descending)
+        if after:
+            start = (after[0] is None, after[0], after[1])
+            nodes = [node for node in nodes if (position(node) < start if descending else position(node) > start)]
+    elif order_by:
+        key, direction = order_by
+        # Nulls sort last in ascending order, as in Cypher.
+        nodes = sorted(nodes, key=lambda node: (node[key] is None, node[key]), reverse=direction == 'desc')
+    return list(nodes[skip:skip + limit])
+
+
+class MemoryBackend(GraphBackend):
+    def __init__(self):
+        self.nodes = {}
+        self.label_index = {}
+        self.adjacency = {}
+        self.id_count = 0
+        self.lock = threading.RLock()
+
+    def begin(self):
+        return MemoryTransaction(self)
+
+    def reserve_id_block(self, block_size):
+        with self.lock:
+            self.id_count += block_size
+            return self.id_count
+
+    def related_ids(self, id, rel_type, direction=None):
+        edges = self.adjacency.get(id, {})
+        if direction:
+            return list(edges.get((rel_type, direction), ()))
+        related = list(edges.get((rel_type, OUTGOING), ()))
+        related.extend(edges.get((rel_type, INCOMING), ()))
+        return related
+
+
+class MemoryTransaction(GraphTransaction):
+    def __init__(self, backend):
+        self.backend = backend
+        self.undo_log = []
+        self.backend.lock.acquire()
+        self.finished = False
+        self.after_commit_callbacks = []
+
+    def commit(self):
+        self._finish()
+        for callback in self.after_commit_callbacks:
+            callback()
+
+    def rollback(self):
+        for undo in reversed(self.undo_log):
+            undo()
+        self._finish()
+
+    def after_commit(self, callback):
+        self.after_commit_callbacks.append(callback)
+
+    def _finish(self):
+        if not self.finished:
+            self.finished = True
+            self.undo_log = []
+            self.backend.lock.release()
+
+    ######### Reads #########
+
+    def get_node_labels(self, id):
+        node = self.backend.nodes.get(id, None)
+        return [label for label in node.labels if label != BASE_LABEL] if node is not None else None
+
+    def get_node(self, id, label=None):
+        node = self.backend.nodes.get(id, None)
+        if node is None or (label and label not in node.labels):
+            return None
+        return node
+
+    # Nodes are not copied out of memory, so properties are not projected.
+    def get_nodes(self, label, constraints=None, limit=100, skip=0, order_by=None, after=None, properties=None):
+        nodes = [self.backend.nodes[id] for id in self.backend.label_index.get(label, ())]
+        return _page(nodes, constraints, limit, skip, order_by, after)
+
+    def get_related_nodes(self, relationship, from_node_id, constraints=None, limit=100, skip=0, order_by=None,
+                          after=None, properties=None):
+        related_ids = self.backend.related_ids(from_node_id, relationship.rel_type, relationship.direction)
+        return _page([self.backend.nodes[id] for id in related_ids], constraints, limit, skip, order_by, after)
+
+    def get_related_nodes_for_ids(self, requests):
+        results = []
+        for relationship, from_node_ids, constraints, limit, skip, order_by, after, properties in requests:
+            related_nodes = {}
+            for from_node_id in OrderedDict.fromkeys(from_node_ids):
+                related_nodes[from_node_id] = [
+                    (node, (self.get_node_labels(node['id']) or [None])[0])
+                    for node in self.get_related_nodes(
+                        relationship, from_node_id, constraints, limit, skip, order_by, after)
+                ]
+            results.append(related_nodes)
+        return results
+
+    def edge_exists(self, rel_type, a_id, b_id, directed=False):
+        return b_id in self.backend.related_ids(a_id, rel_type, OUTGOING if directed else None)
+
+    ######### Writes #########
+
+    def _link(self, from_node_id, rel_type, to_node_id, log=True):
+        adjacency = self.backend.adjacency
+        outgoing = adjacency.setdefault(from_node_id, {}).setdefault((rel_type, OUTGOING), OrderedDict())
+        if to_node_id in outgoing:
+            return
+        outgoing[to_node_id] = True
+        adjacency.setdefault(to_node_id, {}).setdefault((rel_type, INCOMING), OrderedDict())[from_node_id] = True
+        if log:
+            self.undo_log.append(lambda: self._unlink(from_node_id, rel_type, to_node_id, log=False))
+
+    def _unlink(self, from_node_id, rel_type, to_node_id, log=True):
+        adjacency = self.backend.adjacency
+        outgoing = adjacency.get(from_node_id, {}).get((rel_type, OUTGOING), {})
+        if to_node_id not in outgoing:
+            return
+        del outgoing[to_node_id]
+        del adjacency[to_node_id][(rel_type, INCOMING)][from_node_id]
+        if log:
+            self.undo_log.append(lambda: self._link(from_node_id, rel_type, to_node_id, log=False))
+
+    def add_edge(self, relationship, from_node_id, to_node_id):
+        if from_node_id not in self.backend.nodes or to_node_id not in self.backend.nodes:
+            return
+        if relationship.direction == INCOMING:
+            self._link(to_node_id, relationship.rel_type, from_node_id)
+        else:
+            # Unspecified directions are created as outgoing.
+            self._link(from_node_id, relationship.rel_type, to_node_id)
+
+    def remove_edge(self, relationship, from_node_id, to_node_id):
+        if relationship.direction != INCOMING:
+            self._unlink(from_node_id, relationship.rel_type, to_node_id)
+        if relationship.direction != OUTGOING:
+            self._unlink(to_node_id, relationship.rel_type, from_node_id)
+
+    def set_attribute(self, attribute, id, value):
+        node = self.backend.nodes.get(id, None)
+        if node is None:
+            return
+        had_value = attribute.name in node
+        old_value = node[attribute.name]
+        node[attribute.name] = value
+
+        def undo():
+            if had_value:
+                node[attribute.name] = old_value
+            else:
+                node.pop(attribute.name, None)
+        self.undo_log.append(undo)
+
+    def create_node(self, labels, properties):
+        node = Node(labels, properties)
+        self._insert(node)
+        self.undo_log.append(lambda: self._remove(node))
+
+    def delete_node(self, id):
+        node = self.backend.nodes.get(id, None)
+        if node is None:
+            return
+        for rel_type, direction in self.backend.adjacency.get(id, {}).keys():
+            for related_id in self.backend.related_ids(id, rel_type, direction):
+                if direction == OUTGOING:
+                    self._unlink(id, rel_type, related_id)
+                else:
+                    self._unlink(related_id, rel_type, id)
+        self.backend.adjacency.pop(id, None)
+        self._remove(node)
+        self.undo_log.append(lambda: self._insert(node))
+
+    def _insert(self, node):
+        self.backend.nodes[node['id']] = node
+        for label in node.labels:
+            self.backend.label_index.setdefault(label, set()).add(node['id'])
+
+    def _remove(self, node):
+        del self.backend.nodes[node['id']]
+        for label in node.labels:
+            self.backend.label_index[label].discard(node['id'])
@@ -0,0 +1,83 @@
+"""
+A process wide cache of node records.
+
+Every Neo4jTransaction already keeps the nodes it has read, so within a
+request a node is fetched at most once. A NodeCache given to a Neo4jBackend
+is a second, shared tier behind those: nodes read by any transaction are
+kept, labels and properties together, for at most ttl seconds, and a
+transaction which misses its own nodes looks there before going to Neo4j.
+
+Transactions store the records of the nodes they created, and drop those
+of the other nodes they wrote or deleted, when they commit. Writes made by
+other processes, or committed while another transaction was reading the old
+record, are only seen once the record expires, so the ttl should be as short
+as the staleness the models can accept. Labels and created_by never change.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+DEFAULT_NODE_CACHE_SIZE = 100000
+DEFAULT_NODE_CACHE_TTL = 5.0
+
+
+class NodeCache(object):
+    """
+    A thread safe least recently used cache of at most maxsize node records,
+    each of which expires ttl seconds after it was stored.
+    """
+    def __init__(self, maxsize=DEFAULT_NODE_CACHE_SIZE, ttl=DEFAULT_NODE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, id):
+        """
+        Returns the (labels, properties) of the node with the id, or None.
+        The properties are a copy which the caller may modify.
+        """
+        with self._lock:
+            entry = self._entries.pop(id, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self._entries[id] = entry
+            self.hits += 1
+            return entry[1], dict(entry[2])
+
+    def put(self, id, labels, properties):
+        entry = (time.time() + self.ttl, tuple(labels), dict(properties))
+        with self._lock:
+            self._entries.pop(id, None)
+            self._entries[id] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, ids):
+        with self._lock:
+            for id in ids:
+                self._entries.pop(id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -1,21 +1,133 @@
 import types
 import inspect
-import cypher_utils
+import instrumentation
+import query_builder
+from cursors import NEXT_CURSORS_KEY
 from exceptions import PermissionDenied, InvalidValueError, NodeTypeNotFoundError
 
 
+class PermissionCache(object):
+    """
+    Request scoped record of permission decisions. A rule which has allowed
+    an actor access to a node is not evaluated again for that actor and node
+    within the same transaction. Decisions of the built-in Allows rules are
+    shared by every attribute and relationship using them, those of other
+    rules are kept per attribute or relationship, which a rule may read.
+
+    `creators` maps node ids to their created_by value and is filled in
+    whenever nodes are fetched, so that Allows.creator rarely needs a query.
+    """
+    def __init__(self):
+        self.allowed = set()
+        self.creators = {}
+
+    def check(self, rule, graph, actor_id, node_id, tx):
+        key = _decision_key(rule, actor_id, node_id)
+        if key in self.allowed:
+            return
+        rule(graph, actor_id, node_id, tx)
+        self.allowed.add(key)
+
+    def check_many(self, rule, graph, actor_id, node_ids, tx):
+        """
+        Checks the rule for each of the node ids which it has not allowed
+        yet, all at once if the rule declares check_many.
+        """
+        func = getattr(rule, '__func__', rule)
+        unchecked = []
+        seen = set()
+        for node_id in node_ids:
+            if node_id not in seen and _decision_key(rule, actor_id, node_id) not in self.allowed:
+                unchecked.append(node_id)
+            seen.add(node_id)
+        if not unchecked:
+            return
+        batched = getattr(func, 'check_many', None)
+        if batched:
+            batched(getattr(rule, '__self__', None), graph, actor_id, unchecked, tx)
+            self.allowed.update(_decision_key(rule, actor_id, node_id) for node_id in unchecked)
+        else:
+            for node_id in unchecked:
+                self.check(rule, graph, actor_id, node_id, tx)
+
+
+def _decision_key(rule, actor_id, node_id):
+    func = getattr(rule, '__func__', rule)
+    if func in _SHARED_RULES:
+        return (func, actor_id, node_id)
+    return (func, getattr(rule, '__self__', None), actor_id, node_id)
+
+
+def check_permission(rule, graph, actor_id, node_id, tx):
+    with instrumentation.timing('permission'):
+        if tx is None:
+            rule(graph, actor_id, node_id, tx)
+        else:
+            graph.permission_cache(tx).check(rule, graph, actor_id, node_id, tx)
+
+
+def check_permissions(rule, graph, actor_id, node_ids, tx):
+    """
+    Batched form of check_permission for a list of node ids, which may
+    repeat.
+    """
+    with instrumentation.timing('permission'):
+        if tx is None:
+            for node_id in set(node_ids):
+                rule(graph, actor_id, node_id, tx)
+        else:
+            graph.permission_cache(tx).check_many(rule, graph, actor_id, node_ids, tx)
+
+
+def checks_many(check_many):
+    """
+    Declares that a permission rule can also check a list of nodes at once,
+    by calling check_many(self, graph, actor_id, node_ids, tx), which must
+    raise if the rule does not allow any one of them.
+    """
+    def declare(rule):
+        rule.check_many = check_many
+        return rule
+    return declare
+
+
+def _check_creators(self, graph, actor_id, node_ids, tx):
+    creators = graph.permission_cache(tx).creators
+    missing = [node_id for node_id in node_ids if node_id not in creators]
+    if missing:
+        nodes = graph.backend.adopt(tx).get_nodes_by_ids(missing)
+        for node_id in missing:
+            creators[node_id] = nodes[node_id]['created_by'] if node_id in nodes else None
+    for node_id in node_ids:
+        if not actor_id == creators[node_id]:
+            raise PermissionDenied("{}: User {} is not the creator.".format(self.name, actor_id))
+
+
+def _check_nothing(self, graph, actor_id, node_ids, tx):
+    pass
+
+
+def _overrides(obj, base, name):
+    return getattr(type(obj), name).__func__ is not getattr(base, name).__func__
+
+
 class Allows(object):
     """
     Default permissions definitions
     """
 
     @staticmethod
+    @checks_many(_check_creators)
     def creator(self, graph, actor_id, node_id, tx):
-        creator_id = graph.request_subgraph_at_node(-1, {'created_by': None}, node_id, tx=tx)['created_by']
+        creators = graph.permission_cache(tx).creators if tx else {}
+        if node_id not in creators:
+            creators[node_id] = graph.request_subgraph_at_node(-1, {'created_by': None}, node_id, tx=tx)['created_by']
+        creator_id = creators[node_id]
         if not actor_id == creator_id:
             raise PermissionDenied("{}: User {} is not the creator.".format(self.name, actor_id))
 
     @staticmethod
+    @checks_many(_check_nothing)
     def public(self, graph, actor_id, node_id, tx):
         pass
 
@@ -24,28 +136,43 @@ class Allows(object):
         raise PermissionDenied()
 
 
+# The rules which do not depend on the attribute or relationship they are
+# bound to, whose decisions can be shared between them.
+_SHARED_RULES = frozenset([Allows.creator, Allows.public])
+
+
 class Attribute(object):
-    def __init__(self, read=Allows.creator, write=Allows.creator, name=None):
+    def __init__(self, read=Allows.creator, write=Allows.creator, name=None, indexed=False):
+        """
+        Attributes declared indexed are indexed for the nodes of their model
+        by GraphAPI.setup_constraints.
+        """
         self.read = types.MethodType(read, self)
         self.write = types.MethodType(write, self)
+        self.indexed = indexed
 
+        self.name = None
+        if name:
+            self.compile(name)
+
+    def compile(self, name):
+        """
+        Fixes the name of the attribute.
+        """
         self.name = name
 
     def set_value(self, tx, id, value):
         """
         WARNING! Unsafe to pass unvalidated attributes to this function!
         """
-        tx.append("MATCH (n) WHERE n.id = {{id}} SET n.{attribute_name} = {{value}}".format(attribute_name=self.name),
-                  {"id": id,
-                   "value": value})
+        tx.set_attribute(self, id, value)
 
     def get_value(self, tx, id):
         """
         WARNING! Unsafe to pass unvalidated attributes to this function!
         """
-        tx.append("MATCH (n) WHERE n.id = {id} RETURN n", {"id": id})
-        n = tx.process()[-1].one
-        return n[self.name]
+        n = tx.get_node(id)
+        return n[self.name] if n is not None else None
 
     # Property observers
     def did_set(self, graph, actor_id, node_id, old_value, value):
@@ -55,10 +182,22 @@ class Attribute(object):
         pass
 
     def assert_allows_read(self, graph, actor_id, node_id, tx=None):
-        self.read(graph, actor_id, node_id, tx)
+        check_permission(self.read, graph, actor_id, node_id, tx)
 
     def assert_allows_write(self, graph, actor_id, node_id, new_value, tx=None):
-        self.write(graph, actor_id, node_id, tx)
+        check_permission(self.write, graph, actor_id, node_id, tx)
+
+    def assert_allows_writes(self, graph, actor_id, changes, tx=None):
+        """
+        Batched form of assert_allows_write for a list of (node_id, new_value)
+        changes. Subclasses which override assert_allows_write are checked
+        change by change.
+        """
+        if _overrides(self, Attribute, 'assert_allows_write'):
+            for node_id, new_value in changes:
+                self.assert_allows_write(graph, actor_id, node_id, new_value, tx=tx)
+        else:
+            check_permissions(self.write, graph, actor_id, [node_id for node_id, _ in changes], tx)
 
 class FileAttribute(Attribute):
     pass
@@ -82,7 +221,18 @@ class Relationship(object):
         self.remove_edge = types.MethodType(remove_edge, self)
         self.direction = direction
 
+        self.name = None
+        if name:
+            self.compile(name)
+
+    def compile(self, name):
+        """
+        Fixes the name of the relationship and preformats the statements which
+        depend on its type and direction.
+        """
         self.name = name
+        self.remove_query = query_builder.remove_edge(self)
+        self.create_query = query_builder.add_edge(self)
 
     @property
     def rel_type(self):
@@ -99,13 +249,35 @@ class Relationship(object):
         pass
 
     def assert_allows_read(self, graph, actor_id, node_id, tx=None):
-        self.read(graph, actor_id, node_id, tx)
+        check_permission(self.read, graph, actor_id, node_id, tx)
 
     def assert_allows_add_edge(self, graph, actor_id, node_id, id_to_add, tx=None):
-        self.add_edge(graph, actor_id, node_id, tx)
+        check_permission(self.add_edge, graph, actor_id, node_id, tx)
 
     def assert_allows_remove_edge(self, graph, actor_id, node_id, id_to_add, tx=None):
-        self.remove_edge(graph, actor_id, node_id, tx)
+        check_permission(self.remove_edge, graph, actor_id, node_id, tx)
+
+    def assert_allows_add_edges(self, graph, actor_id, edges, tx=None):
+        """
+        Batched form of assert_allows_add_edge for a list of (node_id,
+        related_node_id) edges. Subclasses which override
+        assert_allows_add_edge are checked edge by edge.
+        """
+        if _overrides(self, Relationship, 'assert_allows_add_edge'):
+            for node_id, related_node_id in edges:
+                self.assert_allows_add_edge(graph, actor_id, node_id, related_node_id, tx=tx)
+        else:
+            check_permissions(self.add_edge, graph, actor_id, [node_id for node_id, _ in edges], tx)
+
+    def assert_allows_remove_edges(self, graph, actor_id, edges, tx=None):
+        """
+        Batched form of assert_allows_remove_edge, see assert_allows_add_edges.
+        """
+        if _overrides(self, Relationship, 'assert_allows_remove_edge'):
+            for node_id, related_node_id in edges:
+                self.assert_allows_remove_edge(graph, actor_id, node_id, related_node_id, tx=tx)
+        else:
+            check_permissions(self.remove_edge, graph, actor_id, [node_id for node_id, _ in edges], tx)
 
     def get_reverse_relationship(self, models_dict):
         node_model = models_dict.get(self.target_model_name, None)
@@ -119,47 +291,29 @@ class Relationship(object):
                     return rev_relationship
         return None
 
-    def get_related_nodes_with_constraints(self, tx, from_node_id, constraints=None, limit=100, skip=0, order_by=None):
-        constraint_query = ""
-        if self.direction:
-            if self.direction == "incoming":
-                constraint_query += "MATCH (u {{ id:{} }})<-[:{}]-(v)".format(from_node_id, self.rel_type)
-            else:
-                constraint_query += "MATCH (u {{ id:{} }})-[:{}]->(v)".format(from_node_id, self.rel_type)
-        else:
-            constraint_query += "MATCH (u {{ id:{} }})-[:{}]-(v)".format(from_node_id, self.rel_type)
-        if constraints:
-            constraint_query += " WHERE "
-            constraint_query += cypher_utils.constraints_expression_from_constraints(constraints, node_identifier='v')
-        constraint_query += " RETURN v"
-        if order_by:
-            # TODO: I'm thinking this might be a security hole in that it
-            # allows you to order by fields that you don't have permission to
-            # view. Should fix this eventually.
-            constraint_query += ' ORDER BY v.{}'.format(order_by[0])
-            constraint_query += ' {}'.format(order_by[1].upper())
-        constraint_query += " SKIP {}".format(skip)
-        constraint_query += " LIMIT {}".format(limit)
-        tx.append(constraint_query)
-        return map(lambda r: r[0], tx.process()[-1])
+    def get_related_nodes_with_constraints(self, tx, from_node_id, constraints=None, limit=100, skip=0, order_by=None,
+                                           after=None, properties=None):
+        # TODO: I'm thinking ordering might be a security hole in that it
+        # allows you to order by fields that you don't have permission to
+        # view. Should fix this eventually.
+        return tx.get_related_nodes(self, from_node_id, constraints, limit, skip, order_by, after, properties)
+
+    def get_related_nodes_for_ids(self, tx, from_node_ids, constraints=None, limit=100, skip=0, order_by=None,
+                                  after=None, properties=None):
+        """
+        Batched form of get_related_nodes_with_constraints. Returns a dict
+        mapping each of the from_node_ids to its list of (node, node_type)
+        pairs, with skip and limit applied separately for every parent.
+        """
+        return tx.get_related_nodes_for_ids(
+            [(self, from_node_ids, constraints, limit, skip, order_by, after, properties)])[0]
 
     def remove(self, tx, from_node_id, to_node_id):
-        if self.direction == 'incoming':
-            remove_query = "MATCH (a)<-[r:{rel_type}]-(b) WHERE a.id = {{aid}} AND b.id = {{bid}} DELETE r"
-        elif self.direction == 'outgoing':
-            remove_query = "MATCH (a)-[r:{rel_type}]->(b) WHERE a.id = {{aid}} AND b.id = {{bid}} DELETE r"
-        else:
-            remove_query = "MATCH (a)-[r:{rel_type}]-(b) WHERE a.id = {{aid}} AND b.id = {{bid}} DELETE r"
-        tx.append(remove_query.format(rel_type=self.rel_type), {'aid': from_node_id, 'bid': to_node_id})
+        tx.remove_edge(self, from_node_id, to_node_id)
 
     def add(self, tx, from_node_id, to_node_id):
         # Create the relationship
-        if self.direction == 'incoming':
-            create_query = "MATCH (a),(b) WHERE a.id = {{aid}} AND b.id = {{bid}} MERGE (a)<-[r:{rel_type}]-(b) RETURN r"
-        else:
-            # Either outgoing or unspecified.
-            create_query = "MATCH (a),(b) WHERE a.id = {{aid}} AND b.id = {{bid}} MERGE (a)-[r:{rel_type}]->(b) RETURN r"
-        tx.append(create_query.format(rel_type=self.rel_type), {'aid': from_node_id, 'bid': to_node_id})
+        tx.add_edge(self, from_node_id, to_node_id)
 
 
 class NodeModel(object):
@@ -183,15 +337,41 @@ class NodeModel(object):
         pass
 
     @classmethod
-    def attributes(self):
+    def assert_allows_deletes(self, actor_id, graph, node_ids, tx=None):
+        """
+        Batched form of assert_allows_delete. Override it along with
+        assert_allows_delete to check many nodes at once.
+        """
+        for node_id in node_ids:
+            self.assert_allows_delete(actor_id, graph, node_id, tx=tx)
+
+    @classmethod
+    def compile_schema(self):
+        """
+        Collects the attributes and relationships of the model, including
+        inherited ones, into lookup tables which are kept on the class. The
+        tables are shared by every caller and must not be modified.
+        """
         attr = dict(inspect.getmembers(self, lambda v: isinstance(v, Attribute)))
+        rels = dict(inspect.getmembers(self, lambda v: isinstance(v, Relationship)))
+        if NEXT_CURSORS_KEY in attr or NEXT_CURSORS_KEY in rels:
+            raise ValueError("{}: '{}' is reserved for the cursors of related nodes.".format(
+                self.__name__, NEXT_CURSORS_KEY))
         for k, v in attr.iteritems():
-            v.name = k
-        return attr
+            v.compile(k)
+        for k, v in rels.iteritems():
+            v.compile(k)
+        self._attributes = attr
+        self._relationships = rels
+
+    @classmethod
+    def attributes(self):
+        if '_attributes' not in self.__dict__:
+            self.compile_schema()
+        return self._attributes
 
     @classmethod
     def relationships(self):
-        rels = dict(inspect.getmembers(self, lambda v: isinstance(v, Relationship)))
-        for k, v in rels.iteritems():
-            v.name = k
-        return rels
+        if '_relationships' not in self.__dict__:
+            self.compile_schema()
+        return self._relationships
@@ -1,18 +1,35 @@
 import re
+from plan_cache import LRUCache, freeze
 
 INTEGER_PROPERTIES = set(['limit', 'skip'])
 STRING_PROPERTIES = set([])
 ORDER_BY_PROPERTIES = set(['order_by'])
 CONSTRAINT_PROPERTIES = set(['where'])
 INCLUDE_PROPERTIES = set(['include'])
+# Cursors are opaque strings, and may be empty to ask for the first page.
+CURSOR_PROPERTIES = set(['after'])
+
+QUERY_DICT_CACHE = LRUCache()
 
-def get_query_dict_from_params(params):
-    include_param = params.get('include', None)
-    constraint_param = params.get('where', None)
-    skip_param = params.get('skip', None)
-    order_by_param = params.get('order_by', None)
-    limit_param = params.get('limit', 100)
 
+def get_query_dict_from_params(params):
+    """
+    Parses the query parameters into a query dict. Query dicts are cached by
+    the raw parameter strings, so the returned dict is shared and frozen.
+    """
+    key = (
+        params.get('include', None),
+        params.get('where', None),
+        params.get('skip', None),
+        params.get('order_by', None),
+        params.get('limit', 100),
+        params.get('after', None),
+    )
+    return QUERY_DICT_CACHE.get_or_create(key, lambda: freeze(_parse_query_params(*key)))
+
+
+def _parse_query_params(include_param, constraint_param, skip_param, order_by_param, limit_param,
+                        after_param=None):
     query_dict = {}
     if include_param:
         query_dict['include'] = ParamParser.parse_include_list(include_param)
@@ -21,7 +38,7 @@ def get_query_dict_from_params(params):
         query_dict['where'] = ParamParser.parse_constraint_list(constraint_param)
 
     if order_by_param:
-        query_dict['order_by'] = skip_value
+        query_dict['order_by'] = ParamParser.parse_order_by_params(order_by_param)
 
     if skip_param:
         try:
@@ -38,6 +55,9 @@ def get_query_dict_from_params(params):
             raise ParamParsingException("Non integer value '" + skip_param + "' for an integer property.")
         query_dict['limit'] = limit_value
 
+    if after_param is not None:
+        query_dict['after'] = after_param
+
     return query_dict
 
 
@@ -86,7 +106,7 @@ class ParamParser(object):
         name = property_string.partition('(')[0]
         value = property_string[:-1].partition('(')[-1]
         property_dict = {}
-        if not value:
+        if not value and name not in CURSOR_PROPERTIES:
             raise ParamParsingException()  #All properties must have a value
         if name in INTEGER_PROPERTIES:
             try:
@@ -102,6 +122,8 @@ class ParamParser(object):
             value = ParamParser.parse_order_by_params(value)
         elif name in INCLUDE_PROPERTIES:
             value = ParamParser.parse_include_list(value)
+        elif name in CURSOR_PROPERTIES:
+            pass
         else:
             raise ParamParsingException("Unrecognized property.")
         return name, value
@@ -0,0 +1,110 @@
+"""
+Bounded caches for parsed queries and compiled statements.
+
+Clients tend to send the same handful of include/where strings over and over,
+so both the result of parsing them and the statements compiled from them are
+kept in least recently used caches and shared between requests. Anything
+stored in these caches is shared and is therefore frozen first.
+"""
+from collections import OrderedDict
+import threading
+
+
+DEFAULT_PLAN_CACHE_SIZE = 1024
+
+
+class FrozenDict(dict):
+    """
+    A dict which can not be modified after it is created and which can be
+    hashed, so that frozen query dicts can themselves be used as cache keys.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FrozenDict, self).__init__(*args, **kwargs)
+        self._hash = None
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('FrozenDict can not be modified.')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self.iteritems()))
+        return self._hash
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self), ))
+
+
+def freeze(value):
+    """
+    Recursively converts dicts to FrozenDicts and lists to tuples.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class LRUCache(object):
+    """
+    A thread safe least recently used cache which counts hits, misses and
+    evictions.
+    """
+    def __init__(self, maxsize=DEFAULT_PLAN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_create(self, key, factory):
+        """
+        Returns the value cached for key, calling factory to create and cache
+        it on a miss. The factory is called outside of the lock, so two
+        threads missing at once may both call it.
+        """
+        sentinel = self._entries
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -1,14 +1,98 @@
-class CypherTransactionManager(object):
-    def __init__(self, cypher):
-        self.cypher = cypher
-        self.tx = None
+import threading
+import time
+import instrumentation
+
+
+class ConnectionPool(object):
+    """
+    Bounds the number of requests a GraphAPI has in flight against Neo4j at
+    once, and with it the number of HTTP connections py2neo keeps open, and
+    records how much of that bound is in use. A max_size of None only
+    records usage.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self._semaphore = threading.BoundedSemaphore(max_size) if max_size else None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self._semaphore and not self._semaphore.acquire(False):
+            start = time.time()
+            self._semaphore.acquire()
+            with self._lock:
+                self.waits += 1
+                self.wait_time += time.time() - start
+        with self._lock:
+            self.in_use += 1
+            self.acquired += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
+        if self._semaphore:
+            self._semaphore.release()
+
+    def connection(self):
+        return _PooledConnection(self)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_size': self.max_size,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'acquired': self.acquired,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+            }
+
+
+class _PooledConnection(object):
+    def __init__(self, pool):
+        self.pool = pool
 
     def __enter__(self):
-        self.tx = self.cypher.begin()
-        return self.tx
+        self.pool.acquire()
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type:
-            self.tx.rollback()
-        else:
-            self.tx.commit()
+        self.pool.release()
+
+
+class InstrumentedTransaction(object):
+    """
+    Wraps a py2neo transaction, recording the statements appended to it and
+    the round trips made by process, commit and rollback into the running
+    request.
+    """
+    def __init__(self, tx):
+        self.tx = tx
+
+    def append(self, statement, parameters=None, **kwparameters):
+        instrumentation.record_statement(getattr(statement, 'statement', statement))
+        return self.tx.append(statement, parameters, **kwparameters)
+
+    def process(self):
+        return self._round_trip(self.tx.process)
+
+    def commit(self):
+        return self._round_trip(self.tx.commit)
+
+    def rollback(self):
+        return self._round_trip(self.tx.rollback)
+
+    def __getattr__(self, name):
+        return getattr(self.tx, name)
+
+    def _round_trip(self, send):
+        start = time.time()
+        results = send()
+        rows = sum(len(records) for records in results) if results else 0
+        instrumentation.record_round_trip(time.time() - start, rows)
+        return results
+
@@ -0,0 +1,387 @@
+"""
+Statement templates for every query RibbonGraph sends to Neo4j.
+
+Values (ids, where values, skip and limit) are always passed as {param}
+placeholders so that the text of a statement only depends on its shape and
+Neo4j can reuse its execution plan. The only things spliced into the text are
+labels, relationship types and property names, and those are validated first.
+"""
+import re
+from exceptions import InvalidPropertyError
+
+
+# Every node created by RibbonGraph carries this label in addition to the
+# label of its model, and its id is indexed under it by
+# GraphAPI.setup_constraints, so that id lookups never scan the whole graph.
+BASE_LABEL = 'RibbonNode'
+
+IDENTIFIER_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+NEO4J_OPERATOR_MAPPING = {'!=': '<>', '=': '=', '<': '<', '>': '>', '>=': '>=', '<=': '<=', 'matches': '=~', }
+
+
+def identifier(name):
+    """
+    Returns name if it is safe to splice into a statement as a label,
+    relationship type or property name.
+    """
+    if not isinstance(name, basestring) or not IDENTIFIER_PATTERN.match(name):
+        raise InvalidPropertyError("'{}' is not a valid name.".format(name))
+    return name
+
+
+def constraints_expression(constraints, node_identifier="n", parameter_prefix=None):
+    """
+    Returns the where expression for the constraints and the dictionary of
+    parameters it references.
+    """
+    parameter_prefix = parameter_prefix or node_identifier
+    expression = ""
+    parameters = {}
+    for i, or_constraint in enumerate(constraints):
+        for j, and_constraint in enumerate(or_constraint):
+            attribute_name, operator, value = and_constraint
+            if operator not in NEO4J_OPERATOR_MAPPING:
+                raise InvalidPropertyError("'{}' is not a valid operator.".format(operator))
+            node_attribute_string = "{}.{}".format(node_identifier, identifier(attribute_name))
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+            parameter_name = "{}_c{}_{}".format(parameter_prefix, i, j)
+            parameters[parameter_name] = value
+
+            expression += ' '.join([node_attribute_string, NEO4J_OPERATOR_MAPPING[operator], "{" + parameter_name + "}"])
+            if j < len(or_constraint) - 1:
+                expression += " AND "
+        if i < len(constraints) - 1:
+            expression += " OR "
+    return expression, parameters
+
+
+def order_by_clause(order_by, node_identifier="n", tie_break=False):
+    """
+    Returns the ORDER BY clause for order_by. With tie_break nodes with equal
+    keys are ordered by id, and nodes without an order_by are ordered by id,
+    as keyset pagination needs.
+    """
+    if not order_by:
+        return " ORDER BY {}.id".format(node_identifier) if tie_break else ""
+    direction = order_by[1].upper()
+    if direction not in ('ASC', 'DESC'):
+        raise InvalidPropertyError("'{}' is not a valid ordering.".format(order_by[1]))
+    clause = " ORDER BY {}.{} {}".format(node_identifier, identifier(order_by[0]), direction)
+    if tie_break and order_by[0] != 'id':
+        clause += ", {}.id {}".format(node_identifier, direction)
+    return clause
+
+
+def keyset_expression(order_by, after, node_identifier="n", parameter_prefix=None):
+    """
+    Returns the where expression for the nodes which come after the (value,
+    id) position after in the keyset ordering for order_by, and the
+    parameters it references, but only those in the same section of the
+    ordering as the position: the nodes with a value for the key, or the
+    nodes without one. Nulls come last in ascending order and first in
+    descending order, as in ORDER BY, and the section after the position's
+    is given by keyset_tail_expression.
+
+    For a position with a value the expression is a range on the key, which
+    an index on it can seek to.
+    """
+    parameter_prefix = parameter_prefix or node_identifier
+    key, direction = order_by or ('id', 'asc')
+    comparison = '<' if direction == 'desc' else '>'
+    value, id = after
+    value_parameter = "{}_after_value".format(parameter_prefix)
+    id_parameter = "{}_after_id".format(parameter_prefix)
+    parameters = {id_parameter: id}
+    id_expression = "{}.id {} {{{}}}".format(node_identifier, comparison, id_parameter)
+    if key == 'id':
+        return id_expression, parameters
+
+    node_key = "{}.{}".format(node_identifier, identifier(key))
+    if value is None:
+        return "({key} IS NULL AND {ids})".format(key=node_key, ids=id_expression), parameters
+
+    parameters[value_parameter] = value
+    return "({key} {comparison} {{{value}}} OR ({key} = {{{value}}} AND {ids}))".format(
+        key=node_key, comparison=comparison, value=value_parameter, ids=id_expression), parameters
+
+
+def keyset_tail_expression(order_by, after, node_identifier="n"):
+    """
+    Returns the where expression for the section of the keyset ordering for
+    order_by which follows the section of the position after, or None if it
+    is the last one.
+    """
+    key, direction = order_by or ('id', 'asc')
+    if key == 'id':
+        return None
+    node_key = "{}.{}".format(node_identifier, identifier(key))
+    if direction == 'desc':
+        return "{} IS NOT NULL".format(node_key) if after[0] is None else None
+    return "{} IS NULL".format(node_key) if after[0] is not None else None
+
+
+def _keyset_condition(order_by, after, node_identifier):
+    """
+    Returns the where expression for all of the nodes after the position,
+    whichever section they are in, and its parameters. Only fit for nodes
+    which are not found through an index on the key, such as related nodes.
+    """
+    expression, parameters = keyset_expression(order_by, after, node_identifier)
+    tail = keyset_tail_expression(order_by, after, node_identifier)
+    if tail:
+        expression = "({} OR {})".format(expression, tail)
+    return expression, parameters
+
+
+def relationship_pattern(from_identifier, relationship, to_identifier, to_label=None):
+    """
+    Returns the path pattern between two identifiers that follows the type
+    and direction of the relationship.
+    """
+    rel_type = identifier(relationship.rel_type)
+    to_node = "{}:{}".format(to_identifier, identifier(to_label)) if to_label else to_identifier
+    if relationship.direction == "incoming":
+        return "({})<-[:{}]-({})".format(from_identifier, rel_type, to_node)
+    elif relationship.direction == "outgoing":
+        return "({})-[:{}]->({})".format(from_identifier, rel_type, to_node)
+    return "({})-[:{}]-({})".format(from_identifier, rel_type, to_node)
+
+
+def projection(node_identifier, properties):
+    """
+    Returns a map of the id and the properties of the node, for statements
+    which need only some of its properties.
+    """
+    names = ['id'] + [identifier(name) for name in properties if name != 'id']
+    return "{" + ", ".join("{name}: {node}.{name}".format(name=name, node=node_identifier) for name in names) + "}"
+
+
+def model_labels(node_identifier):
+    """
+    Returns an expression for the labels of the node other than BASE_LABEL.
+    """
+    return "[l IN labels({}) WHERE l <> '{}']".format(node_identifier, BASE_LABEL)
+
+
+######### Statements #########
+
+def create_id_constraint():
+    return "CREATE CONSTRAINT ON (n:{}) ASSERT n.id IS UNIQUE".format(BASE_LABEL)
+
+
+def drop_id_constraint():
+    return "DROP CONSTRAINT ON (n:{}) ASSERT n.id IS UNIQUE".format(BASE_LABEL)
+
+
+def create_index(label, property_name):
+    return "CREATE INDEX ON :{}({})".format(identifier(label), identifier(property_name))
+
+
+def create_id_counter():
+    return "MERGE (id:_GlobalUniqueId) ON CREATE SET id.count = 0"
+
+
+def reserve_id_block():
+    return ("MERGE (id:_GlobalUniqueId) "
+            "ON CREATE SET id.count = {block_size} "
+            "ON MATCH SET id.count = id.count + {block_size} "
+            "RETURN id.count")
+
+
+def label_unlabeled_nodes(label):
+    """
+    Adds BASE_LABEL to at most {batch_size} nodes which have the label but
+    not yet BASE_LABEL, returning how many were labeled. The nodes are found
+    with a scan of the label rather than of the whole store.
+    """
+    return ("MATCH (n:{label}) WHERE NOT n:{base} AND exists(n.id) "
+            "WITH n LIMIT {{batch_size}} "
+            "SET n:{base} "
+            "RETURN count(n)").format(label=identifier(label), base=BASE_LABEL)
+
+
+def node_by_id(label=None):
+    if label:
+        return "MATCH (n:{}) WHERE n.id = {{id}} AND n:{} RETURN n".format(BASE_LABEL, identifier(label))
+    return "MATCH (n:{}) WHERE n.id = {{id}} RETURN n".format(BASE_LABEL)
+
+
+def create_node(labels):
+    return "CREATE (n:{} {{properties}})".format(':'.join(identifier(label) for label in labels))
+
+
+def delete_node_by_id():
+    return "MATCH (n:{}) WHERE n.id = {{id}} DETACH DELETE n".format(BASE_LABEL)
+
+
+def set_properties_by_id():
+    return "MATCH (n:{}) WHERE n.id = {{id}} SET n += {{properties}}".format(BASE_LABEL)
+
+
+def edge_between(rel_type, directed=False):
+    arrow = "->" if directed else "-"
+    return "MATCH (a:{base})-[r:{rel_type}]{arrow}(b:{base}) WHERE a.id = {{aid}} AND b.id = {{bid}} RETURN r".format(
+        base=BASE_LABEL, rel_type=identifier(rel_type), arrow=arrow)
+
+
+def remove_edge(relationship):
+    return "MATCH {} WHERE a.id = {{aid}} AND b.id = {{bid}} DELETE r".format(
+        relationship_pattern('a:' + BASE_LABEL, relationship, 'b', BASE_LABEL).replace('[:', '[r:'))
+
+
+def _created_edge_pattern(relationship):
+    rel_type = identifier(relationship.rel_type)
+    if relationship.direction == 'incoming':
+        return "(a)<-[r:{}]-(b)".format(rel_type)
+    # Unspecified directions are created as outgoing.
+    return "(a)-[r:{}]->(b)".format(rel_type)
+
+
+def add_edge(relationship):
+    return "MATCH (a:{base}),(b:{base}) WHERE a.id = {{aid}} AND b.id = {{bid}} MERGE {pattern} RETURN r".format(
+        base=BASE_LABEL, pattern=_created_edge_pattern(relationship))
+
+
+def _returned_page(node_identifier, order_by, tie_break, properties):
+    """
+    Returns the end of a statement which returns a page of the node. A
+    projection is only made once the page has been cut, so that the node
+    can be ordered by properties which are not projected.
+    """
+    order = order_by_clause(order_by, node_identifier, tie_break)
+    if not properties:
+        return " RETURN {}{} SKIP {{skip}} LIMIT {{limit}}".format(node_identifier, order)
+    return " WITH {}{} SKIP {{skip}} LIMIT {{limit}} RETURN {}".format(
+        node_identifier, order, projection(node_identifier, properties))
+
+
+def nodes_with_constraints(label, constraints=None, order_by=None, after=None, properties=None, tail=False):
+    """
+    Returns the statement and parameters for a page of nodes with the label,
+    which is a keyset page after the position after unless it is None, of
+    the section of the ordering the position is in, or with tail of the
+    section after it (see keyset_expression). Only the projection of the
+    properties is returned if they are given. The caller adds the skip and
+    limit parameters.
+    """
+    parameters = {}
+    statement = "MATCH (n:{})".format(identifier(label))
+    conditions = []
+    if constraints:
+        expression, parameters = constraints_expression(constraints)
+        conditions.append(expression)
+    if after and tail:
+        conditions.append(keyset_tail_expression(order_by, after))
+    elif after:
+        expression, keyset_parameters = keyset_expression(order_by, after)
+        conditions.append(expression)
+        parameters.update(keyset_parameters)
+    if len(conditions) > 1:
+        statement += " WHERE ({}) AND {}".format(*conditions)
+    elif conditions:
+        statement += " WHERE " + conditions[0]
+    statement += _returned_page('n', order_by, after is not None, properties)
+    return statement, parameters
+
+
+def related_nodes_with_constraints(relationship, constraints=None, order_by=None, after=None, properties=None):
+    """
+    Returns the statement and parameters for a page of nodes related to the
+    node with id {id}, which is a keyset page after the position after unless
+    it is None. Only the projection of the properties is returned if they are
+    given. The caller adds the id, skip and limit parameters.
+    """
+    parameters = {}
+    statement = "MATCH " + relationship_pattern('u:' + BASE_LABEL, relationship, 'v') + " WHERE u.id = {id}"
+    if constraints:
+        expression, parameters = constraints_expression(constraints, node_identifier='v')
+        statement += " AND ({})".format(expression)
+    if after:
+        expression, keyset_parameters = _keyset_condition(order_by, after, 'v')
+        statement += " AND " + expression
+        parameters.update(keyset_parameters)
+    statement += _returned_page('v', order_by, after is not None, properties)
+    return statement, parameters
+
+
+def related_nodes_for_ids(relationship, constraints=None, order_by=None, after=None, properties=None):
+    """
+    Returns the statement and parameters for the pages of nodes related to
+    each of the nodes with ids in {ids}, which are keyset pages after the
+    position after unless it is None. Only the projection of the properties
+    is returned if they are given. The caller adds the ids, skip and end
+    parameters.
+    """
+    parameters = {}
+    statement = "UNWIND {ids} AS uid "
+    statement += "MATCH " + relationship_pattern('u:' + BASE_LABEL, relationship, 'v') + " WHERE u.id = uid"
+    if constraints:
+        expression, parameters = constraints_expression(constraints, node_identifier='v')
+        statement += " AND ({})".format(expression)
+    if after:
+        expression, keyset_parameters = _keyset_condition(order_by, after, 'v')
+        statement += " AND " + expression
+        parameters.update(keyset_parameters)
+    statement += " WITH uid, v"
+    statement += order_by_clause(order_by, 'v', tie_break=after is not None)
+    statement += " WITH uid, collect(v)[{skip}..{end}] AS related"
+    statement += " UNWIND related AS v"
+    statement += " RETURN uid, {}, head({})".format(
+        projection('v', properties) if properties else "v", model_labels('v'))
+    return statement, parameters
+
+
+######### Batched statements #########
+
+def nodes_by_ids():
+    return "UNWIND {{ids}} AS id MATCH (n:{}) WHERE n.id = id RETURN n".format(BASE_LABEL)
+
+
+def create_nodes(labels):
+    """
+    Creates a node with the labels for each of the property maps in {rows}.
+    """
+    return "UNWIND {{rows}} AS properties CREATE (n:{}) SET n = properties".format(
+        ':'.join(identifier(label) for label in labels))
+
+
+def set_properties_for_rows():
+    """
+    Adds row.properties to the node with id row.id for each row in {rows}.
+    """
+    return "UNWIND {{rows}} AS row MATCH (n:{}) WHERE n.id = row.id SET n += row.properties".format(BASE_LABEL)
+
+
+def add_edges(relationship):
+    """
+    Adds an edge from the node with id row.aid to the node with id row.bid
+    for each row in {rows}.
+    """
+    return ("UNWIND {{rows}} AS row MATCH (a:{base}),(b:{base}) WHERE a.id = row.aid AND b.id = row.bid "
+            "MERGE {pattern}").format(base=BASE_LABEL, pattern=_created_edge_pattern(relationship))
+
+
+def existing_edges(relationship):
+    """
+    Returns the rows of {rows} for which there is an edge of the relationship
+    from the node with id row.aid to the node with id row.bid.
+    """
+    return "UNWIND {{rows}} AS row MATCH {} WHERE a.id = row.aid AND b.id = row.bid RETURN DISTINCT row.aid, row.bid".format(
+        relationship_pattern('a:' + BASE_LABEL, relationship, 'b', BASE_LABEL))
+
+
+def delete_nodes_by_ids():
+    return "UNWIND {{ids}} AS id MATCH (n:{}) WHERE n.id = id DETACH DELETE n".format(BASE_LABEL)
+
+
+def delete_edges_of_nodes():
+    """
+    Deletes at most {limit} of the edges of the nodes with ids in {ids},
+    returning how many were deleted.
+    """
+    return ("UNWIND {{ids}} AS id MATCH (n:{})-[r]-() WHERE n.id = id "
+            "WITH DISTINCT r LIMIT {{limit}} DELETE r RETURN count(r)").format(BASE_LABEL)
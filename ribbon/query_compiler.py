@@ -0,0 +1,180 @@
+"""
+Compiles an include dict, as produced by ParamParser.parse_include_list, into a
+single Cypher statement which returns the entire requested tree in one row.
+
+Each included relationship becomes an OPTIONAL MATCH whose related nodes are
+ordered, cut down to their page and unwound again before the nested level is
+matched, so that only the nodes of the page are expanded, and whose
+projections are then collected into a list before the next sibling is
+matched. Skip, limit, order_by and where are all applied per parent node.
+"""
+import query_builder
+from exceptions import InvalidPropertyError
+
+
+DEFAULT_LIMIT = 100
+DEFAULT_SKIP = 0
+DEFAULT_CONSTRAINTS = None
+
+
+class CompilationError(Exception):
+    """
+    Raised when an include dict can not be expressed as a single statement,
+    in which case the caller should fall back to expanding the tree itself.
+    """
+    pass
+
+
+class LevelPlan(object):
+    """
+    The compiled description of a single level of the requested tree.
+
+    `attributes` is a list of (key, Attribute) and `relationships` is a list
+    of (key, Relationship, LevelPlan) in the order they appear in the
+    statement.
+    """
+    def __init__(self, node_model):
+        self.node_model = node_model
+        self.attributes = []
+        self.relationships = []
+
+
+class CompiledSubgraphQuery(object):
+    def __init__(self, statement, parameters, plan):
+        self.statement = statement
+        self.parameters = parameters
+        self.plan = plan
+
+    def parameters_for_id(self, id):
+        parameters = dict(self.parameters)
+        parameters['id'] = id
+        return parameters
+
+    def rebuild(self, row, creators=None):
+        """
+        Rebuilds the nested dictionary returned by _request_subgraph_at_node
+        from the single row returned by the compiled statement. The creator
+        of every node in the row is recorded in `creators` when given.
+        """
+        return _rebuild_level(self.plan, row, creators)
+
+
+def _rebuild_level(plan, row, creators):
+    if row is None:
+        return None
+    results = {'id': row['id']}
+    if creators is not None:
+        creators[row['id']] = row['created_by']
+    for key, attribute in plan.attributes:
+        results[key] = row[key]
+    for key, relationship, nested_plan in plan.relationships:
+        related = [_rebuild_level(nested_plan, related_row, creators) for related_row in row[key] or []]
+        if relationship.max_edges == 1:
+            results[key] = related[0] if related else None
+        else:
+            results[key] = related
+    return results
+
+
+class SubgraphQueryCompiler(object):
+    """
+    Turns (node_model, include_dict) pairs into CompiledSubgraphQuery objects.
+    The statement text depends only on the shape of the include dict, the
+    values in it are all passed as parameters.
+    """
+
+    def __init__(self, models_dict):
+        self.models_dict = models_dict
+
+    def compile(self, node_model, include_dict):
+        lines = []
+        parameters = {}
+        counter = [0]
+        root = 'n0'
+        lines.append('MATCH ({root}:{base}) WHERE {root}.id = {{id}} AND {root}:{label}'.format(
+            root=root, base=query_builder.BASE_LABEL, label=query_builder.identifier(node_model.__name__)))
+        plan, projection, _ = self._compile_level(lines, parameters, counter, root, node_model, include_dict, [root])
+        lines.append('RETURN {} AS result'.format(projection))
+        return CompiledSubgraphQuery(' '.join(lines), parameters, plan)
+
+    def _compile_level(self, lines, parameters, counter, identifier, node_model, include_dict, scope):
+        plan = LevelPlan(node_model)
+        entries = ['id: {}.id'.format(identifier)]
+        collected = []
+        # The creator is always fetched along with the node because the
+        # default permission rules need it.
+        if not include_dict or 'created_by' not in include_dict:
+            entries.append('created_by: {}.created_by'.format(identifier))
+        if not include_dict:
+            return plan, '{' + ', '.join(entries) + '}', [identifier]
+
+        attributes = node_model.attributes()
+        relationships = node_model.relationships()
+        for include_key in sorted(include_dict):
+            if include_key in attributes:
+                plan.attributes.append((include_key, attributes[include_key]))
+                entries.append('{key}: {identifier}.{key}'.format(key=include_key, identifier=identifier))
+
+            elif include_key in relationships:
+                relationship = relationships[include_key]
+                target_model = self.models_dict.get(relationship.target_model_name, None)
+                if not target_model:
+                    raise CompilationError(relationship.target_model_name)
+
+                counter[0] += 1
+                related = 'n{}'.format(counter[0])
+                nested_query_dict = include_dict[include_key] or {}
+                if 'after' in nested_query_dict:
+                    # Cursors need the order_by key of the last node of the
+                    # page, which the compiled projection leaves out.
+                    raise CompilationError('Keyset pages are read breadth first.')
+                skip = nested_query_dict.get('skip', DEFAULT_SKIP)
+                limit = nested_query_dict.get('limit', DEFAULT_LIMIT)
+                order_by = nested_query_dict.get('order_by', None)
+                constraints = nested_query_dict.get('where', DEFAULT_CONSTRAINTS)
+                nested_include_dict = nested_query_dict.get('include', None)
+
+                match = 'OPTIONAL MATCH ' + query_builder.relationship_pattern(
+                    identifier, relationship, related, target_model.__name__)
+                if constraints:
+                    expression, constraint_parameters = query_builder.constraints_expression(constraints, related)
+                    match += ' WHERE ' + expression
+                    parameters.update(constraint_parameters)
+                lines.append(match)
+
+                outer_scope = scope + collected
+                page = '{}_page'.format(related)
+                parameters['{}_skip'.format(related)] = skip
+                parameters['{}_end'.format(related)] = skip + limit
+                if order_by:
+                    lines.append('WITH ' + ', '.join(outer_scope + [related]) +
+                                 query_builder.order_by_clause(order_by, related))
+                lines.append('WITH {scope}, collect({related})[{{{related}_skip}}..{{{related}_end}}] AS {page}'.format(
+                    scope=', '.join(outer_scope), related=related, page=page))
+                # A parent without related nodes keeps its row, with a null.
+                lines.append('UNWIND CASE WHEN size({page}) = 0 THEN [NULL] ELSE {page} END AS {related}'.format(
+                    page=page, related=related))
+
+                nested_plan, nested_projection, nested_scope = self._compile_level(
+                    lines, parameters, counter, related, target_model, nested_include_dict, outer_scope + [related])
+
+                if order_by:
+                    lines.append('WITH ' + ', '.join(outer_scope + nested_scope) +
+                                 query_builder.order_by_clause(order_by, related))
+
+                collected_identifier = '{}_list'.format(related)
+                lines.append(
+                    'WITH {scope}, collect(CASE WHEN {related} IS NULL THEN NULL ELSE {projection} END)'
+                    ' AS {collected}'.format(
+                        scope=', '.join(outer_scope),
+                        related=related,
+                        projection=nested_projection,
+                        collected=collected_identifier))
+                collected.append(collected_identifier)
+
+                plan.relationships.append((include_key, relationship, nested_plan))
+                entries.append('{}: {}'.format(include_key, collected_identifier))
+            else:
+                raise InvalidPropertyError("There is no '{}' property.".format(include_key))
+
+        return plan, '{' + ', '.join(entries) + '}', [identifier] + collected
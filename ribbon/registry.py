@@ -0,0 +1,59 @@
+"""
+A process wide registry of GraphAPI instances.
+
+Building a GraphAPI creates a py2neo.Graph (and with it a fresh set of HTTP
+connections) and compiles the schema of every model, so views should share
+one instance per database and model set rather than building one per request.
+"""
+import threading
+from graph import GraphAPI
+
+
+DEFAULT_MAX_CONNECTIONS = 10
+
+_graph_apis = {}
+_lock = threading.Lock()
+
+
+def get_graph_api(database_url=None, models=[], **kwargs):
+    """
+    Returns the shared GraphAPI for the database url and set of models,
+    creating it on first use. Extra keyword arguments are passed to GraphAPI
+    when it is created, and max_connections defaults to
+    DEFAULT_MAX_CONNECTIONS.
+    """
+    key = (database_url, frozenset(models))
+    graph_api = _graph_apis.get(key, None)
+    if graph_api:
+        return graph_api
+    with _lock:
+        graph_api = _graph_apis.get(key, None)
+        if not graph_api:
+            kwargs.setdefault('max_connections', DEFAULT_MAX_CONNECTIONS)
+            graph_api = GraphAPI(database_url, models=models, **kwargs)
+            _graph_apis[key] = graph_api
+    return graph_api
+
+
+def warm_up(database_url=None, models=[], **kwargs):
+    """
+    Creates the shared GraphAPI and connects it to the database, meant to be
+    called when the process starts.
+    """
+    graph_api = get_graph_api(database_url, models, **kwargs)
+    graph_api.warm_up()
+    return graph_api
+
+
+def health():
+    """
+    Returns the health check of every registered GraphAPI.
+    """
+    with _lock:
+        graph_apis = _graph_apis.values()
+    return [graph_api.health_check() for graph_api in graph_apis]
+
+
+def clear():
+    with _lock:
+        _graph_apis.clear()
@@ -0,0 +1,28 @@
+"""
+Incremental JSON encoding of streamed subgraphs.
+
+iter_json turns the trees yielded by GraphAPI.stream_subgraphs into the
+chunks of a JSON array, encoding each tree only when the previous chunk has
+been sent, so it can be handed straight to a Django StreamingHttpResponse:
+
+    trees = api.stream_subgraphs(user.id, query_dict, node_type)
+    return StreamingHttpResponse(iter_json(trees), content_type='application/json')
+
+Once the first chunk is sent the status of the response is fixed, so an
+error raised while streaming, such as a PermissionDenied for a later tree,
+aborts the response rather than turning into an error response.
+"""
+import json
+
+
+def iter_json(subgraphs, cls=None, **kwargs):
+    """
+    Yields a JSON array of the subgraphs one chunk per subgraph. The encoder
+    class and keyword arguments are those of json.dumps.
+    """
+    encoder = (cls or json.JSONEncoder)(**kwargs)
+    separator = '['
+    for subgraph in subgraphs:
+        yield separator + encoder.encode(subgraph)
+        separator = ','
+    yield ']' if separator == ',' else '[]'
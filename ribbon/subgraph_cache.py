@@ -0,0 +1,268 @@
+"""
+Opt-in caches of the trees returned by request_subgraph_at_node.
+
+A tree is cached per actor, root node, node type and include dict, since the
+read permissions of the actor decide what it contains. Every node that
+appears in a tree is tracked: each node has a version counter which is
+bumped after every committed change to its attributes or edges (from the
+change stack of the update), and a cached tree is only served while the
+versions of all of its nodes are those it was read at.
+
+Versions are read after the tree is, so a tree read while a change commits
+could be stored under the versions bumped by that change. Every invalidation
+therefore also bumps an epoch, which readers take before reading, and a tree
+is not stored if the epoch moved on in the meantime.
+
+Only the nodes in a tree are tracked, so a related node which is not in the
+tree because of a where, skip or limit does not invalidate it by changing.
+Such trees, and any rule which depends on more than the actor and the node,
+are only as fresh as the timeout of the cache.
+
+MemorySubgraphCache keeps the trees of one process in an LRUCache.
+SharedSubgraphCache keeps them in a cache shared by many processes, such as
+one of Django's caches.
+"""
+import copy
+import hashlib
+import json
+import threading
+import time
+from node_model import Attribute, Relationship
+from plan_cache import LRUCache
+
+
+DEFAULT_SUBGRAPH_CACHE_SIZE = 10000
+# Seconds a tree is served for at most, which bounds how stale a tree with
+# untracked dependencies can be.
+DEFAULT_SUBGRAPH_CACHE_TIMEOUT = 300
+
+
+def touched_node_ids(change_stack):
+    """
+    Returns the ids of the nodes whose attributes or edges the changes of a
+    change stack modified.
+    """
+    ids = set()
+    for change in change_stack:
+        if isinstance(change[0], Attribute):
+            ids.add(change[1])
+        elif isinstance(change[0], Relationship):
+            ids.update(change[1:3])
+        elif change[1] == 'delete':
+            ids.add(change[2])
+    return ids
+
+
+def tree_node_ids(tree, ids=None):
+    """
+    Returns the ids of all of the nodes in a tree.
+    """
+    ids = set() if ids is None else ids
+    if isinstance(tree, list):
+        for subtree in tree:
+            tree_node_ids(subtree, ids)
+    elif isinstance(tree, dict):
+        if 'id' in tree:
+            ids.add(tree['id'])
+        for value in tree.itervalues():
+            if isinstance(value, (dict, list)):
+                tree_node_ids(value, ids)
+    return ids
+
+
+class SubgraphCache(object):
+    """
+    The keying and validation of cached trees. Subclasses store the entries,
+    version counters and epoch by overriding get_entry, set_entry,
+    get_versions, bump_versions, epoch and bump_epoch.
+    """
+    def __init__(self, timeout=DEFAULT_SUBGRAPH_CACHE_TIMEOUT):
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.discarded = 0
+        self.invalidations = 0
+
+    def key(self, actor_id, id, node_type, include_dict):
+        # Equal include dicts serialize equally whatever their key order.
+        include = json.dumps(include_dict, sort_keys=True, separators=(',', ':'))
+        return 'subgraph:{}:{}:{}:{}'.format(actor_id, id, node_type, hashlib.sha1(include).hexdigest())
+
+    def get(self, actor_id, id, node_type, include_dict):
+        """
+        Returns a copy of the cached tree, or None if there is no tree or it
+        is no longer valid.
+        """
+        entry = self.get_entry(self.key(actor_id, id, node_type, include_dict))
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, versions, tree = entry
+        if expires_at < time.time() or self.get_versions(versions.keys()) != versions:
+            self.stale += 1
+            return None
+        self.hits += 1
+        return copy.deepcopy(tree)
+
+    def put(self, actor_id, id, node_type, include_dict, tree, epoch=None):
+        """
+        Caches a tree read in a transaction which has ended, unless a change
+        was invalidated since the epoch, taken before the tree was read.
+        """
+        versions = self.get_versions(tree_node_ids(tree))
+        if epoch is not None and self.epoch() != epoch:
+            self.discarded += 1
+            return
+        entry = (time.time() + self.timeout, versions, copy.deepcopy(tree))
+        self.set_entry(self.key(actor_id, id, node_type, include_dict), entry)
+
+    def invalidate(self, ids):
+        """
+        Invalidates every cached tree which contains one of the nodes.
+        """
+        if ids:
+            self.invalidations += 1
+            # The epoch moves on first, so that a reader which read none of
+            # the bumped versions may still find it unchanged.
+            self.bump_epoch()
+            self.bump_versions(ids)
+
+    def get_entry(self, key):
+        raise NotImplementedError()
+
+    def set_entry(self, key, entry):
+        raise NotImplementedError()
+
+    def get_versions(self, ids):
+        """
+        Returns a dict mapping each of the ids to the version of its node.
+        """
+        raise NotImplementedError()
+
+    def bump_versions(self, ids):
+        raise NotImplementedError()
+
+    def epoch(self):
+        """
+        Returns the current epoch, which changes with every invalidation.
+        """
+        raise NotImplementedError()
+
+    def bump_epoch(self):
+        raise NotImplementedError()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'discarded': self.discarded,
+            'invalidations': self.invalidations,
+        }
+
+
+class MemorySubgraphCache(SubgraphCache):
+    """
+    Caches at most maxsize trees in process. The version counters are kept
+    for every node ever changed, which costs a few dozen bytes a node.
+    """
+    def __init__(self, maxsize=DEFAULT_SUBGRAPH_CACHE_SIZE, timeout=DEFAULT_SUBGRAPH_CACHE_TIMEOUT):
+        super(MemorySubgraphCache, self).__init__(timeout)
+        self.entries = LRUCache(maxsize)
+        self.versions = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get_entry(self, key):
+        return self.entries.get(key)
+
+    def set_entry(self, key, entry):
+        self.entries.put(key, entry)
+
+    def get_versions(self, ids):
+        with self._lock:
+            return dict((id, self.versions.get(id, 0)) for id in ids)
+
+    def bump_versions(self, ids):
+        with self._lock:
+            for id in ids:
+                self.versions[id] = self.versions.get(id, 0) + 1
+
+    def epoch(self):
+        with self._lock:
+            return self._epoch
+
+    def bump_epoch(self):
+        with self._lock:
+            self._epoch += 1
+
+    def stats(self):
+        stats = super(MemorySubgraphCache, self).stats()
+        stats.update(self.entries.stats())
+        return stats
+
+
+class SharedSubgraphCache(SubgraphCache):
+    """
+    Caches trees in a cache with the interface of Django's caches (get,
+    set, add, get_many and incr), such as caches['default'], so that they
+    are shared by every process using it.
+
+    Version counters and the epoch never expire, and a counter which the
+    cache evicted anyway starts again from the current time rather than from
+    zero, so that it can not come back to a value a reader has seen.
+    """
+    def __init__(self, cache, prefix='ribbon', timeout=DEFAULT_SUBGRAPH_CACHE_TIMEOUT):
+        super(SharedSubgraphCache, self).__init__(timeout)
+        self.cache = cache
+        self.prefix = prefix
+
+    def _version_key(self, id):
+        return '{}:version:{}'.format(self.prefix, id)
+
+    def _epoch_key(self):
+        return '{}:epoch'.format(self.prefix)
+
+    def get_entry(self, key):
+        return self.cache.get('{}:{}'.format(self.prefix, key))
+
+    def set_entry(self, key, entry):
+        self.cache.set('{}:{}'.format(self.prefix, key), entry, self.timeout)
+
+    def get_versions(self, ids):
+        ids = list(ids)
+        keys = [self._version_key(id) for id in ids]
+        found = self.cache.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            start = int(time.time() * 1000000)
+            for key in missing:
+                self.cache.add(key, start, None)
+            found.update(self.cache.get_many(missing))
+        return dict((id, found.get(key)) for id, key in zip(ids, keys))
+
+    def bump_versions(self, ids):
+        for id in ids:
+            key = self._version_key(id)
+            try:
+                self.cache.incr(key)
+            except ValueError:
+                # Nothing can have been cached at a counter which does not
+                # exist, so the next read may start it afresh.
+                pass
+
+    def epoch(self):
+        key = self._epoch_key()
+        epoch = self.cache.get(key)
+        if epoch is None:
+            self.cache.add(key, int(time.time() * 1000000), None)
+            epoch = self.cache.get(key)
+        return epoch
+
+    def bump_epoch(self):
+        key = self._epoch_key()
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.add(key, int(time.time() * 1000000), None)
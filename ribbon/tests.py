@@ -0,0 +1,517 @@
+import threading
+import time
+import unittest
+from backends import Neo4jBackend, Neo4jTransaction
+from graph import GraphAPI, _merge_did_set
+from listeners import ListenerDispatcher, run_async
+from memory_backend import MemoryBackend
+from exceptions import InvalidPropertyError, NodeNotFoundError, PermissionDenied
+from node_model import NodeModel, Attribute, Relationship, Allows, PermissionCache, checks_many
+from query_compiler import CompilationError
+from subgraph_cache import MemorySubgraphCache
+
+
+class User(NodeModel):
+    name = Attribute(read=Allows.public, write=Allows.public)
+    friends = Relationship('User', rel_type='FRIEND', read=Allows.public)
+
+
+class Post(NodeModel):
+    title = Attribute(read=Allows.public, write=Allows.public)
+    author = Relationship('User', rel_type='AUTHORED', direction='incoming', max_edges=1, read=Allows.public)
+
+
+class Note(NodeModel):
+    text = Attribute(read=Allows.public, write=Allows.creator)
+    readers = Relationship('User', rel_type='READS', read=Allows.public, add_edge=Allows.public)
+
+
+class Locked(NodeModel):
+    name = Attribute(read=Allows.public, write=Allows.public)
+
+    @classmethod
+    def assert_allows_delete(self, actor_id, graph, node_id, tx=None):
+        raise PermissionDenied()
+
+
+class FakeNode(dict):
+    def __init__(self, labels, properties):
+        super(FakeNode, self).__init__(properties)
+        self.labels = set(labels)
+        self.properties = dict(properties)
+
+
+class FakeRecords(list):
+    @property
+    def one(self):
+        return self[0][0] if self else None
+
+
+class FakeCypherTransaction(object):
+    """
+    A py2neo transaction over a fixed set of nodes, which records the
+    statements appended to it.
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.appended = []
+        self.unprocessed = []
+        self.committed = None
+
+    def append(self, statement, parameters=None, **kwparameters):
+        self.appended.append((statement, parameters))
+        self.unprocessed.append(parameters or {})
+
+    def process(self):
+        results = []
+        for parameters in self.unprocessed:
+            node = self.nodes.get(parameters.get('id', None), None)
+            results.append(FakeRecords([[node]] if node is not None else []))
+        self.unprocessed = []
+        return results
+
+    def commit(self):
+        self.committed = list(self.appended)
+
+
+class AdoptedTransactionTests(unittest.TestCase):
+    def setUp(self):
+        self.graph = GraphAPI(models=[User], backend=Neo4jBackend())
+        self.node = FakeNode(['RibbonNode', 'User'], {'id': 7, 'created_by': 1, 'name': 'a'})
+        self.tx = FakeCypherTransaction({7: self.node})
+
+    def test_update_reaches_callers_transaction(self):
+        self.graph.update_subgraph_at_node(1, 'update', {'name': 'b'}, id=7, tx=self.tx)
+        self.tx.commit()
+        writes = [parameters for _, parameters in self.tx.committed if 'properties' in (parameters or {})]
+        self.assertEqual(writes, [{'id': 7, 'properties': {'name': 'b'}}])
+
+    def test_update_in_memory_transaction(self):
+        graph = GraphAPI(models=[User], backend=MemoryBackend())
+        graph.setup_constraints()
+        node = graph.update_subgraph_at_node(1, 'create', {'name': 'a'}, node_type='User')
+        with graph.backend.transaction() as tx:
+            graph.update_subgraph_at_node(1, 'update', {'name': 'b'}, id=node['id'], tx=tx)
+        self.assertEqual(graph.request_subgraph_at_node(1, {'name': None}, node['id'])['name'], 'b')
+
+
+class RelatedNodesForIdsTests(unittest.TestCase):
+    def test_repeated_ids_are_expanded_once(self):
+        GraphAPI(models=[User], backend=Neo4jBackend())
+        raw = FakeCypherTransaction({})
+        tx = Neo4jTransaction(raw)
+        results = tx.get_related_nodes_for_ids([(User.friends, [4, 1, 4, 1], None, 10, 0, None, None, None)])
+        self.assertEqual(raw.appended[0][1]['ids'], [4, 1])
+        self.assertEqual(results, [{4: [], 1: []}])
+
+
+class SubgraphCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = MemorySubgraphCache()
+        self.graph = GraphAPI(models=[User], backend=MemoryBackend(), subgraph_cache=self.cache)
+        self.graph.setup_constraints()
+        self.node = self.graph.update_subgraph_at_node(1, 'create', {'name': 'a'}, node_type='User')
+
+    def test_tree_read_during_invalidation_is_not_cached(self):
+        epoch = self.cache.epoch()
+        self.cache.invalidate([self.node['id']])
+        self.cache.put(1, self.node['id'], None, {'name': None}, {'id': self.node['id'], 'name': 'a'}, epoch)
+        self.assertIsNone(self.cache.get(1, self.node['id'], None, {'name': None}))
+
+    def test_update_in_callers_transaction_invalidates_on_commit(self):
+        self.graph.request_subgraph_at_node(1, {'name': None}, self.node['id'])
+        invalidations = self.cache.invalidations
+        tx = self.graph.backend.begin()
+        self.graph.update_subgraph_at_node(1, 'update', {'name': 'b'}, id=self.node['id'], tx=tx)
+        self.assertEqual(self.cache.invalidations, invalidations)
+        tx.commit()
+        self.assertEqual(self.graph.request_subgraph_at_node(1, {'name': None}, self.node['id'])['name'], 'b')
+
+
+class KeysetTests(unittest.TestCase):
+    def test_null_tail_is_read_once_values_run_out(self):
+        raw = FakeCypherTransaction({})
+        tx = Neo4jTransaction(raw)
+        tx.get_nodes('User', limit=10, skip=2, order_by=('name', 'asc'), after=('a', 7))
+        (seek, seek_parameters), (tail, tail_parameters) = raw.appended
+        self.assertNotIn('IS NULL', seek)
+        self.assertEqual((seek_parameters['skip'], seek_parameters['limit']), (0, 12))
+        self.assertIn('n.name IS NULL', tail)
+        self.assertEqual((tail_parameters['skip'], tail_parameters['limit']), (0, 12))
+
+
+class ListenerDispatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def block(self, dispatcher):
+        # Keeps a worker busy until release is set.
+        dispatcher.dispatch(run_async(lambda: self.release.wait(5)), ())
+
+    def record(self, name):
+        return run_async(lambda *args: self.calls.append((name,) + args))
+
+    def test_sync_listeners_run_immediately(self):
+        dispatcher = ListenerDispatcher()
+        dispatcher.dispatch(lambda *args: self.calls.append(args), (1, 2))
+        self.assertEqual(self.calls, [(1, 2)])
+
+    def test_edge_listeners_are_not_merged(self):
+        dispatcher = ListenerDispatcher(max_workers=1)
+        add, remove = self.record('add'), self.record('remove')
+        self.block(dispatcher)
+        dispatcher.dispatch(add, (1, 2), serial_key=(1, 2))
+        dispatcher.dispatch(remove, (1, 2), serial_key=(1, 2))
+        dispatcher.dispatch(add, (1, 2), serial_key=(1, 2))
+        self.release.set()
+        self.assertTrue(dispatcher.drain(5))
+        self.assertEqual(self.calls, [('add', 1, 2), ('remove', 1, 2), ('add', 1, 2)])
+
+    def test_merged_did_set_moves_to_the_back(self):
+        dispatcher = ListenerDispatcher(max_workers=1)
+        did_set, other = self.record('did_set'), self.record('other')
+        self.block(dispatcher)
+        dispatcher.dispatch(did_set, (None, 1, 7, 'a', 'b'), coalesce_key=7, merge=_merge_did_set)
+        dispatcher.dispatch(other, ())
+        dispatcher.dispatch(did_set, (None, 1, 7, 'b', 'c'), coalesce_key=7, merge=_merge_did_set)
+        self.release.set()
+        self.assertTrue(dispatcher.drain(5))
+        self.assertEqual(self.calls, [('other',), ('did_set', None, 1, 7, 'a', 'c')])
+        self.assertEqual(dispatcher.stats()['coalesced'], 1)
+
+    def test_calls_with_the_same_key_never_overlap(self):
+        dispatcher = ListenerDispatcher(max_workers=2)
+        started = threading.Event()
+
+        @run_async
+        def did_set(graph, actor_id, node_id, old_value, new_value):
+            self.calls.append(('start', new_value))
+            if new_value == 'b':
+                started.set()
+                self.release.wait(5)
+            self.calls.append(('end', new_value))
+
+        dispatcher.dispatch(did_set, (None, 1, 7, 'a', 'b'), coalesce_key=7, merge=_merge_did_set)
+        self.assertTrue(started.wait(5))
+        dispatcher.dispatch(did_set, (None, 1, 7, 'b', 'c'), coalesce_key=7, merge=_merge_did_set)
+        time.sleep(0.05)
+        self.release.set()
+        self.assertTrue(dispatcher.drain(5))
+        self.assertEqual(self.calls, [('start', 'b'), ('end', 'b'), ('start', 'c'), ('end', 'c')])
+
+    def test_full_queue_runs_listener_on_caller(self):
+        dispatcher = ListenerDispatcher(max_workers=1, max_queue_size=1, queue_timeout=0.01)
+        listener = self.record('listener')
+        self.block(dispatcher)
+        time.sleep(0.05)
+        dispatcher.dispatch(listener, (1,))
+        dispatcher.dispatch(listener, (2,))
+        self.assertEqual(self.calls, [('listener', 2)])
+        self.release.set()
+        self.assertTrue(dispatcher.drain(5))
+        self.assertEqual(dispatcher.stats()['overflowed'], 1)
+
+
+class QueryCompilerTests(unittest.TestCase):
+    def setUp(self):
+        self.compiler = GraphAPI(models=[User, Post], backend=MemoryBackend()).query_compiler
+
+    def test_single_statement(self):
+        compiled = self.compiler.compile(
+            Post, {'title': None, 'author': {'where': [[('name', '=', 'a')]], 'include': {'name': None}}})
+        self.assertEqual(
+            compiled.statement,
+            'MATCH (n0:RibbonNode) WHERE n0.id = {id} AND n0:Post '
+            'OPTIONAL MATCH (n0)<-[:AUTHORED]-(n1:User) WHERE n1.name = {n1_c0_0} '
+            'WITH n0, collect(n1)[{n1_skip}..{n1_end}] AS n1_page '
+            'UNWIND CASE WHEN size(n1_page) = 0 THEN [NULL] ELSE n1_page END AS n1 '
+            'WITH n0, collect(CASE WHEN n1 IS NULL THEN NULL ELSE '
+            '{id: n1.id, created_by: n1.created_by, name: n1.name} END) AS n1_list '
+            'RETURN {id: n0.id, created_by: n0.created_by, author: n1_list, title: n0.title} AS result')
+        self.assertEqual(compiled.parameters, {'n1_c0_0': 'a', 'n1_skip': 0, 'n1_end': 100})
+        self.assertEqual(compiled.parameters_for_id(3)['id'], 3)
+
+    def test_nested_page_is_cut_before_it_is_expanded(self):
+        compiled = self.compiler.compile(User, {'friends': {
+            'order_by': ('name', 'desc'), 'skip': 5, 'limit': 10, 'include': {'friends': None}}})
+        statement = compiled.statement
+        self.assertLess(statement.index('AS n1_page'), statement.index('OPTIONAL MATCH (n1)'))
+        self.assertLess(statement.index('ORDER BY n1.name DESC'), statement.index('AS n1_page'))
+        self.assertEqual((compiled.parameters['n1_skip'], compiled.parameters['n1_end']), (5, 15))
+
+    def test_values_are_parameters(self):
+        first = self.compiler.compile(User, {'friends': {'limit': 1, 'where': [[('name', '=', 'a')]]}})
+        second = self.compiler.compile(User, {'friends': {'limit': 2, 'where': [[('name', '=', 'b')]]}})
+        self.assertEqual(first.statement, second.statement)
+        self.assertNotEqual(first.parameters, second.parameters)
+
+    def test_uncompilable_include_dicts(self):
+        self.assertRaises(CompilationError, self.compiler.compile, User, {'friends': {'after': ''}})
+        self.assertRaises(InvalidPropertyError, self.compiler.compile, User, {'bogus': None})
+
+    def test_rebuild(self):
+        compiled = self.compiler.compile(Post, {'title': None, 'author': {'include': {'name': None}}})
+        creators = {}
+        row = {'id': 2, 'created_by': 1, 'title': 't', 'author': [{'id': 1, 'created_by': 1, 'name': 'a'}]}
+        self.assertEqual(compiled.rebuild(row, creators), {'id': 2, 'title': 't', 'author': {'id': 1, 'name': 'a'}})
+        self.assertEqual(creators, {1: 1, 2: 1})
+        row['author'] = []
+        self.assertEqual(compiled.rebuild(row)['author'], None)
+
+
+class UpdateSubgraphsTests(unittest.TestCase):
+    def setUp(self):
+        self.graph = GraphAPI(models=[User, Post, Note], backend=MemoryBackend())
+        self.graph.setup_constraints()
+        self.user = self.graph.update_subgraph_at_node(1, 'create', {'name': 'a'}, node_type='User')
+        self.note = self.graph.update_subgraph_at_node(1, 'create', {'text': 'x'}, node_type='Note')
+
+    def read(self, id, include_dict):
+        return self.graph.request_subgraph_at_node(1, include_dict, id)
+
+    def test_flat_updates(self):
+        results = self.graph.update_subgraphs(1, [
+            {'update_type': 'update', 'id': self.note['id'], 'update_dict': {'text': 'y'}},
+            {'update_type': 'create', 'node_type': 'Note',
+             'update_dict': {'text': 'z', 'readers': {'attach': [{'id': self.user['id']}]}}},
+            {'update_type': 'update', 'id': self.user['id'], 'update_dict': {'name': 'b'}},
+        ])
+        self.assertEqual([result['success'] for result in results], [True, True, True])
+        created = results[1]['result']
+        self.assertEqual(created['readers'], [{'id': self.user['id']}])
+        self.assertEqual(self.read(self.note['id'], {'text': None})['text'], 'y')
+        self.assertEqual(self.read(created['id'], {'text': None, 'readers': None})['readers'], [{'id': self.user['id']}])
+        self.assertEqual(self.read(self.user['id'], {'name': None})['name'], 'b')
+
+    def test_failures_are_reported_per_tree(self):
+        results = self.graph.update_subgraphs(2, [
+            {'update_type': 'update', 'id': self.note['id'], 'update_dict': {'text': 'y'}},
+            {'update_type': 'update', 'id': 999, 'update_dict': {'text': 'y'}},
+            {'update_type': 'update', 'id': self.user['id'], 'update_dict': {'bogus': 1}},
+            {'update_type': 'create', 'node_type': 'Note', 'update_dict': {'text': 'z'}},
+            {'update_type': 'update', 'id': self.note['id'], 'update_dict': 'malformed'},
+        ])
+        self.assertEqual(
+            [result.get('status_code', None) for result in results], [403, 404, 400, None, 400])
+        self.assertTrue(results[3]['success'])
+        self.assertEqual(self.read(self.note['id'], {'text': None})['text'], 'x')
+        self.assertEqual(self.read(results[3]['result']['id'], {'text': None})['text'], 'z')
+
+    def test_nested_updates_are_applied_one_by_one(self):
+        results = self.graph.update_subgraphs(1, [
+            {'update_type': 'create', 'node_type': 'Post',
+             'update_dict': {'title': 't', 'author': {'attach': {'id': self.user['id']}}}},
+            {'update_type': 'create', 'node_type': 'Post',
+             'update_dict': {'title': 'u', 'author': {'attach': {'id': 999}}}},
+        ])
+        self.assertTrue(results[0]['success'])
+        self.assertEqual(results[1]['status_code'], 404)
+        post = self.read(results[0]['result']['id'], {'author': None})
+        self.assertEqual(post['author']['id'], self.user['id'])
+
+
+class RecordingBackend(MemoryBackend):
+    """
+    Records the transactions of delete_nodes, whose edge deletes report
+    the counts in edge_counts.
+    """
+    def __init__(self):
+        super(RecordingBackend, self).__init__()
+        self.deleted = []
+        self.edge_deletes = []
+        self.edge_counts = []
+
+    def begin(self):
+        tx = super(RecordingBackend, self).begin()
+        delete_nodes = tx.delete_nodes
+
+        def record_delete_nodes(ids):
+            self.deleted.append(list(ids))
+            return delete_nodes(ids)
+
+        def record_delete_edges_of_nodes(ids, limit):
+            self.edge_deletes.append(list(ids))
+            return self.edge_counts.pop(0) if self.edge_counts else 0
+
+        tx.delete_nodes = record_delete_nodes
+        tx.delete_edges_of_nodes = record_delete_edges_of_nodes
+        return tx
+
+
+class DeleteNodesTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = RecordingBackend()
+        self.graph = GraphAPI(models=[User, Locked], backend=self.backend)
+        self.graph.setup_constraints()
+        self.ids = [self.graph.update_subgraph_at_node(1, 'create', {'name': str(i)}, node_type='User')['id']
+                    for i in xrange(5)]
+
+    def exists(self, id):
+        with self.graph.backend.transaction() as tx:
+            return tx.get_node(id) is not None
+
+    def test_nodes_are_deleted_in_chunks(self):
+        self.backend.edge_counts = [2, 2, 1]
+        deleted = self.graph.delete_nodes(1, self.ids + self.ids[:1], chunk_size=2, edge_chunk_size=2)
+        self.assertEqual(deleted, self.ids)
+        self.assertEqual(self.backend.deleted, [self.ids[0:2], self.ids[2:4], self.ids[4:5]])
+        # The edges of the first chunk take three transactions.
+        self.assertEqual(self.backend.edge_deletes[:4], [self.ids[0:2]] * 3 + [self.ids[2:4]])
+        self.assertFalse(any(self.exists(id) for id in self.ids))
+
+    def test_missing_node_deletes_nothing(self):
+        self.assertRaises(NodeNotFoundError, self.graph.delete_nodes, 1, self.ids + [999])
+        self.assertEqual(self.backend.deleted, [])
+        self.assertTrue(all(self.exists(id) for id in self.ids))
+
+    def test_denied_node_deletes_nothing(self):
+        locked = self.graph.update_subgraph_at_node(1, 'create', {'name': 'l'}, node_type='Locked')
+        self.assertRaises(PermissionDenied, self.graph.delete_nodes, 1, self.ids + [locked['id']])
+        self.assertEqual(self.backend.deleted, [])
+        self.assertTrue(self.exists(locked['id']))
+
+
+class PermissionCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.cache = PermissionCache()
+
+    def test_allowed_decisions_are_reused(self):
+        def rule(self_, graph, actor_id, node_id, tx):
+            self.calls.append(node_id)
+        attribute = Attribute(read=rule)
+        self.cache.check(attribute.read, None, 1, 7, None)
+        self.cache.check(attribute.read, None, 1, 7, None)
+        self.cache.check(attribute.read, None, 2, 7, None)
+        self.assertEqual(self.calls, [7, 7])
+
+    def test_denied_decisions_are_not_kept(self):
+        def rule(self_, graph, actor_id, node_id, tx):
+            self.calls.append(node_id)
+            raise PermissionDenied()
+        attribute = Attribute(read=rule)
+        for _ in xrange(2):
+            self.assertRaises(PermissionDenied, self.cache.check, attribute.read, None, 1, 7, None)
+        self.assertEqual(self.calls, [7, 7])
+
+    def test_user_rules_are_kept_per_attribute(self):
+        def only_public(self_, graph, actor_id, node_id, tx):
+            if self_.name != 'public':
+                raise PermissionDenied()
+        public, secret = Attribute(read=only_public, name='public'), Attribute(read=only_public, name='secret')
+        self.cache.check(public.read, None, 1, 7, None)
+        self.assertRaises(PermissionDenied, self.cache.check, secret.read, None, 1, 7, None)
+        self.assertRaises(PermissionDenied, self.cache.check_many, secret.read, None, 1, [7], None)
+
+    def test_built_in_rules_are_shared(self):
+        graph = GraphAPI(models=[User], backend=MemoryBackend())
+        with graph.backend.transaction() as tx:
+            cache = graph.permission_cache(tx)
+            cache.creators[7] = 1
+            cache.check(Attribute(write=Allows.creator).write, graph, 1, 7, tx)
+            cache.creators[7] = 2
+            # Allows.creator does not read the attribute, so its decision holds for any other.
+            cache.check(Attribute(write=Allows.creator).write, graph, 1, 7, tx)
+
+    def test_check_many_batches_unchecked_nodes(self):
+        def check_many(self_, graph, actor_id, node_ids, tx):
+            self.calls.append(list(node_ids))
+
+        @checks_many(check_many)
+        def rule(self_, graph, actor_id, node_id, tx):
+            self.calls.append(node_id)
+        attribute = Attribute(read=rule)
+        self.cache.check(attribute.read, None, 1, 3, None)
+        self.cache.check_many(attribute.read, None, 1, [3, 4, 5, 4], None)
+        self.cache.check_many(attribute.read, None, 1, [4, 5], None)
+        self.assertEqual(self.calls, [3, [4, 5]])
+
+    def test_update_checks_each_rule_once(self):
+        @checks_many(lambda self_, graph, actor_id, node_ids, tx: self.calls.append(sorted(node_ids)))
+        def rule(self_, graph, actor_id, node_id, tx):
+            self.calls.append(node_id)
+
+        class Counted(NodeModel):
+            name = Attribute(read=Allows.public, write=rule)
+            friends = Relationship('Counted', rel_type='COUNTED', read=Allows.public, add_edge=rule)
+
+        graph = GraphAPI(models=[Counted], backend=MemoryBackend())
+        graph.setup_constraints()
+        ids = [graph.update_subgraph_at_node(-1, 'create', {}, node_type='Counted')['id'] for _ in xrange(3)]
+        graph.update_subgraph_at_node(1, 'update', {
+            'name': 'a', 'friends': {'attach': [{'id': id, 'name': 'b'} for id in ids[1:]]}}, id=ids[0])
+        # One batch for the writes and one for the edges, each owning its decisions.
+        self.assertEqual(self.calls, [sorted(ids)] * 2)
+
+
+class StreamSubgraphsTests(unittest.TestCase):
+    def setUp(self):
+        self.graph = GraphAPI(models=[User], backend=MemoryBackend())
+        self.graph.setup_constraints()
+        self.ids = [self.graph.update_subgraph_at_node(1, 'create', {'name': str(i % 3)}, node_type='User')['id']
+                    for i in xrange(7)]
+
+    def test_batches_cover_every_node_once(self):
+        for query_dict in ({}, {'order_by': ('name', 'asc')}, {'order_by': ('name', 'desc'), 'skip': 2}):
+            expected = [tree['id'] for tree in self.graph.query_for_subgraphs(1, dict(query_dict, after=''), 'User')]
+            streamed = [tree['id'] for tree in self.graph.stream_subgraphs(1, query_dict, 'User', batch_size=2)]
+            self.assertEqual(streamed, expected)
+            self.assertEqual(len(streamed), 7 - query_dict.get('skip', 0))
+
+    def test_no_transaction_is_held_between_batches(self):
+        trees = self.graph.stream_subgraphs(1, {}, 'User', batch_size=2)
+        next(trees)
+        acquired = []
+
+        def acquire():
+            # The memory backend holds its lock for as long as a transaction is open.
+            if self.graph.backend.lock.acquire(False):
+                acquired.append(True)
+                self.graph.backend.lock.release()
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        thread.join()
+        self.assertEqual(acquired, [True])
+        trees.close()
+
+
+class LabelExistingNodesTests(unittest.TestCase):
+    def test_each_label_is_scanned_on_its_own(self):
+        backend = Neo4jBackend()
+        statements = []
+        counts = {'User': [2, 1], 'Post': [0]}
+
+        def execute_one(statement, parameters):
+            label = statement.split(':')[1].split(')')[0]
+            statements.append((label, parameters['batch_size']))
+            return counts[label].pop(0)
+        cypher = type('Cypher', (object,), {'execute_one': staticmethod(execute_one)})()
+        backend.neograph = type('Graph', (object,), {'cypher': cypher})()
+        self.assertEqual(backend.label_existing_nodes(['User', 'Post'], 2), 3)
+        self.assertEqual(statements, [('User', 2), ('User', 2), ('Post', 2)])
+
+
+class NextCursorsTests(unittest.TestCase):
+    def test_nested_cursors_are_returned_beside_the_relationship(self):
+        graph = GraphAPI(models=[User], backend=MemoryBackend())
+        graph.setup_constraints()
+        friends = [graph.update_subgraph_at_node(1, 'create', {'name': str(i)}, node_type='User')['id']
+                   for i in xrange(3)]
+        root = graph.update_subgraph_at_node(
+            1, 'create', {'friends': {'attach': [{'id': id} for id in friends]}}, node_type='User')['id']
+        include_dict = {'friends': {'limit': 2, 'after': '', 'include': {'name': None}}}
+        tree = graph.request_subgraph_at_node(1, include_dict, root, breadth_first=True)
+        self.assertEqual([friend['id'] for friend in tree['friends']], friends[:2])
+        include_dict['friends']['after'] = tree['next_cursors']['friends']
+        tree = graph.request_subgraph_at_node(1, include_dict, root, breadth_first=True)
+        self.assertEqual([friend['id'] for friend in tree['friends']], friends[2:])
+        self.assertEqual(tree['next_cursors'], {'friends': None})
+
+    def test_models_may_not_use_the_key(self):
+        class Clashing(NodeModel):
+            next_cursors = Attribute()
+        self.assertRaises(ValueError, GraphAPI, models=[Clashing], backend=MemoryBackend())
@@ -32,5 +32,6 @@ setup(
     install_requires=[
         'py2neo',
         'djangorestframework',
+        'futures; python_version < "3.2"',
     ],
 )